@@ -3,10 +3,26 @@
 import mrcfile
 import numpy as np
 import math
+import mmap
 import sys
 import os
 import glob
 import argparse
+import json
+import collections
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 use_pyfftw = True
@@ -16,6 +32,10 @@ if use_pyfftw:
     except ImportError:
         print('Fourier transform calculations will be faster if you install the pyfftw module! (using numpy.fft instead)')
         use_pyfftw = False
+if use_pyfftw:
+    from tomo_fft import fftw_plans
+from tomo_fft import fft_padding_modes, fast_fft_shape, pad_image, crop_image, fourier_bin, fftw_planning_efforts, default_fftw_planning, fftw_wisdom_file
+from tomo_fft import update_stats, set_header_stats
 
 
 
@@ -45,6 +65,40 @@ class ArgumentParser():
             help='Set this to just check the files and not actually apply dose weighting.')
         add('--custom_dose_series', default=None, type=str,
             help='A custom comma delimited list of the doses to apply. This overwites the --dose_per_tilt value given above (must be in the same order as the images. eg 2,4,6,8,10,12,14,16,18)')
+        add('--half_spectrum', action='store_true',
+            help='Use a real to complex FFT with a half plane filter. This roughly halves the FFT time and the memory used by each image.')
+        add('--batch_size', default=default_batch_size, type=int,
+            help='The number of tilts to filter together in one batched FFT. 0 chooses the batch size from --batch_memory.')
+        add('--batch_memory', default=default_batch_memory, type=float,
+            help='Memory budget (in GB) for each batch of tilts. Only used if --batch_size is 0.')
+        add('--radial_lookup', action='store_true',
+            help='Build each filter from a 1D radial profile and a precalculated radius map. Much faster but approximate (see radial_lookup_bins).')
+        add('--streaming', action='store_true',
+            help='Read the stack through a memory map and write each batch of tilts straight into the output file. Peak memory is then set by the batch size rather than the stack size.')
+        add('--jobs', default=1, type=int,
+            help='The number of tilt series to dose weight at the same time (each in its own process).')
+        add('--threads', default=1, type=int,
+            help='The number of threads used for each tilt series (batches of tilts are filtered in parallel). 0 shares all the cores between the --jobs. Reduced if --jobs x --threads is more than the number of cores.')
+        add('--pipeline', action='store_true',
+            help='Read the next batch of tilts and write the previous one in background threads while the current batch is filtered. Implies --streaming. Helps most on slow (eg network) storage.')
+        add('--in_place', action='store_true',
+            help='Overwrite each tilt of the stack with its filtered image (through a memory map) rather than writing a new stack. Implies --streaming. Stacks must be float32 (mode 2). A stack that was not finished (eg after a crash) is left with a %s file next to it and is skipped by later runs.' % in_place_marker_suffix)
+        add('--sharpen', action='store_true',
+            help='Also apply the dose weighting sharpening filter of tomo_doseweight_sharpen (for --dose_per_tilt after --pre_dose) in the same FFT, rather than running tomo_doseweight_sharpen on the output.')
+        add('--sharpen_number_of_tilts', default=0, type=int,
+            help='The number of tilts for --sharpen (see tomo_doseweight_sharpen --number_of_tilts). 0 uses the number of tilts in each stack.')
+        add('--binned_outputs', default='', type=str,
+            help='A comma delimited list of binning factors (eg 2,4,8). For each a Fourier cropped binned copy of the stack (<name>_bin2.st) and of the dose weighted stack (<name>_dw_bin2.st) is written in the same pass. Not with --fft_padding.')
+        add('--force', action='store_true',
+            help='Dose weight every stack again. Otherwise a stack is skipped if its output is up to date (see the %s file written next to each output) and only the tilts whose dose changed are filtered again.' % manifest_suffix)
+        add('--fft_padding', default='none', choices=fft_padding_modes,
+            help='Pad the images to the next size with no prime factors above 7 before the FFT (and crop them back after). The padding is the mean of the edge pixels (edge_mean) or a mirror image of the edge (mirror). Faster for awkward (eg odd binned) image sizes.')
+        add('--filter_cache_memory', default=default_filter_cache_memory, type=float,
+            help='Memory (in GB) for keeping filters (as float32) between tilt series of the same shape, pixel size and doses. This is for all the --jobs together (each gets an equal share). Only used if each job has more than one tilt series. If the filters of a stack do not all fit, only those of its first doses are kept. The least recently used filters are dropped first. 0 turns this off.')
+        add('--fftw_planning', default=default_fftw_planning, choices=fftw_planning_efforts,
+            help='How hard FFTW (pyfftw) looks for a fast plan for each new image shape. estimate plans at once. measure and above can find faster plans but take seconds to minutes per shape (and per batch size) the first time. Their plans are saved in %s so later runs reuse them.' % fftw_wisdom_file)
+        add('--single_precision', action='store_true',
+            help='Calculate the filters and FFTs in single precision (float32/complex64). Halves the memory used and moved. The result differs from the double precision one by less than 1e-5 of the image RMS (mean included, as the complex64 rounding error scales with the pixel values rather than their spread).')
 
         if len(sys.argv) == 1:  # if no args print usage.
             self.usage()
@@ -82,6 +136,19 @@ class ArgumentParser():
             if args.tilt_scheme not in dose_symmetric_tilt_schemes and args.dose_symmetric_group_size != default_dose_symmetric_group_size:
                 self.error('dose_symmetric_group_size not required with %s tilt scheme' % (args.tilt_scheme))
 
+        if args.sharpen and args.dose_per_tilt == None:
+            self.error('--sharpen needs --dose_per_tilt')
+
+        if args.binned_outputs != '':
+            try:
+                factors = [int(factor) for factor in args.binned_outputs.split(',')]
+            except ValueError:
+                self.error('--binned_outputs must be a comma delimited list of integers (eg 2,4,8)')
+            if min(factors) < 2:
+                self.error('The --binned_outputs factors must be 2 or more')
+            if args.fft_padding != 'none':
+                self.error('--binned_outputs can not be used with --fft_padding')
+
         if sys.version_info < (2, 7):
             self.error("Python version 2.7 or later is required.")
 
@@ -92,6 +159,14 @@ plot_filters = []  # [0,10,29] #[0,1,2]
 keep_header_apix = True #use the original pixel size in the header of the output file. (apix is still used for the dose weighting). This avoids mismatches in pixel size between the input and output stacks.
 default_starting_tilt_angle = 0
 default_dose_symmetric_group_size = 1
+default_batch_size = 0
+default_batch_memory = 2.0
+default_filter_cache_memory = 4.0  # for all the --jobs together. Room for the float32 filters of a 60 tilt K3 (5760 x 4092) stack with --half_spectrum (or about 40 tilts of its full spectrum)
+filter_dtype = 'float32'  # the per dose filters are kept and applied in single precision (whatever the FFT precision) to halve the filter bank and workspace
+manifest_suffix = '.dw_manifest'  # records the input stack, doses and settings each output was made from
+in_place_marker_suffix = '.dw_in_progress'  # marks a stack being dose weighted in place until it is finished
+pipeline_queue_depth = 2  # the most batches waiting to be filtered (and waiting to be written) in --pipeline mode
+radial_lookup_bins = 262144  # number of radial bins between zero and the highest frequency. The filters then differ from the exact ones by < 1e-4 (for pixel sizes >= 0.5 A).
 ####
 if plot_filters != []:  # only use if matplotlib available
     import matplotlib.pyplot as plt
@@ -185,14 +260,89 @@ def tilt_order_from_tilt_scheme(tilt_scheme, min_angle, angle_step, total_tilts,
     return order_list
 
 
+class FilterBank:
+    # Filters (and frequency arrays) kept between the tilt series dose weighted in one process. Once max_memory is
+    # reached the least recently used are dropped first. Shared by the batch threads.
+    def __init__(self, max_memory=default_filter_cache_memory):
+        self.max_memory = max_memory  # in GB
+        self.arrays = collections.OrderedDict()  # least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, count=True):
+        with self.lock:
+            value = self.arrays.pop(key, None)
+            if value is not None:
+                self.arrays[key] = value  # now the most recently used
+            if count:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+
+    def put(self, key, value):
+        # value is an array or a tuple of arrays. They are made read only as they are shared.
+        arrays = value if type(value) == tuple else (value,)
+        nbytes = sum(array.nbytes for array in arrays)
+        max_bytes = self.max_memory * 1024 ** 3
+        if nbytes > max_bytes:
+            return
+        for array in arrays:
+            array.setflags(write=False)
+        with self.lock:
+            if key in self.arrays:
+                self.nbytes -= self.array_bytes(self.arrays.pop(key))
+            while self.nbytes + nbytes > max_bytes:
+                self.nbytes -= self.array_bytes(self.arrays.popitem(last=False)[1])
+            self.arrays[key] = value
+            self.nbytes += nbytes
+
+    def array_bytes(self, value):
+        arrays = value if type(value) == tuple else (value,)
+        return sum(array.nbytes for array in arrays)
+
+
+filter_bank = FilterBank()
+
+
+class FilterWorkspace:
+    # One filter buffer per thread that every batch of filters is written into, rather than a new array (and its
+    # temporaries) for each batch. It only grows if a batch needs more planes or a different shape.
+    def __init__(self):
+        self.thread_buffers = threading.local()
+
+    def get(self, shape, dtype):
+        buffer = getattr(self.thread_buffers, 'buffer', None)
+        if buffer is None or buffer.shape[1:] != shape[1:] or buffer.dtype != np.dtype(dtype) or buffer.shape[0] < shape[0]:
+            buffer = self.thread_buffers.buffer = None  # frees the old one first
+            buffer = self.thread_buffers.buffer = np.empty(shape, dtype=dtype)
+        return buffer[:shape[0]]
+
+
+filter_workspace = FilterWorkspace()
+
+
 class DoseWeight:
-    def __init__(self, images, doses, apix, file_append, plot_filters=[0]):
+    def __init__(self, images, doses, apix, file_append, plot_filters=[0], half_spectrum=False, batch_size=default_batch_size,
+                 batch_memory=default_batch_memory, radial_lookup=False, streaming=False, threads=1, pipeline=False,
+                 single_precision=False, filter_cache_memory=default_filter_cache_memory, fft_padding='none', in_place=False,
+                 binning=[], sharpen=False, sharpen_number_of_tilts=0, fftw_planning=default_fftw_planning):
         self.a = 0.245
         self.b = -1.665
         self.c = 2.81
         self.files = images  # list of 2D images or a single mrc stack of images
         self.is_stack = True if type(self.files) != list else False
-        if self.is_stack:
+        self.pipeline = pipeline  # read and write batches in background threads while filtering
+        self.in_place = in_place and self.is_stack  # filtered tilts are written back over the input stack
+        self.streaming = streaming or pipeline or self.in_place  # read the stack through a memory map and write each batch straight to the output file
+        if self.is_stack and self.streaming:
+            self.in_mrc = mrcfile.mmap(self.files, mode='r+' if self.in_place else 'r')
+            self.images, self.header_apix = self.in_mrc.data, self.in_mrc.voxel_size
+            self.number_of_files = self.images.shape[0]
+        elif self.is_stack:
             self.images, self.header_apix = self.read_image(self.files)
             self.number_of_files = self.images.shape[0]
             self.filtered_images = np.empty(self.images.shape, dtype='float32')
@@ -205,12 +355,38 @@ class DoseWeight:
         self.plot_filters = plot_filters  # list of indices to plot from the images list
         self.plot_filters = [x for x in self.plot_filters if
                              x >= 0 and x < self.number_of_files]  # remove nonsense values
+        self.half_spectrum = half_spectrum  # use rfft2/irfft2 with a filter covering only the non-negative x frequencies
+        self.batch_size = batch_size  # number of tilts transformed together. 0 sizes batches to fit in batch_memory
+        self.batch_memory = batch_memory  # in GB
+        self.radial_lookup = radial_lookup  # build filters from a radial profile instead of the full frequency array
+        self.radius_index = None
+        self.radial_factors = None
+        self.threads = threads if self.plot_filters == [] else 1  # the plotting is not thread safe
+        self.fft_threads = 1
+        self.single_precision = single_precision  # float32 frequencies and filters and complex64 FFTs (pyfftw, or numpy 2)
+        self.float_dtype = 'float32' if single_precision else 'float64'
+        filter_bank.max_memory = filter_cache_memory
+        if use_pyfftw:
+            fftw_plans.planning = fftw_planning
+        self.fft_padding = fft_padding  # pad each image to an FFT friendly size (see fft_padding_modes)
+        self.fft_shape = None
+        self.spectrum_shape = None
+        self.tilts = None  # only filter these tilts (into the existing output stack). None filters all of them
+        self.binning = sorted(set(binning)) if self.is_stack else []  # binning factors of the extra binned output stacks
+        self.binned_stacks = {}  # (factor, filtered) -> open binned output stack
+        self.sharpen = sharpen  # multiply every filter by the sharpening filter of tomo_doseweight_sharpen
+        self.sharpen_number_of_tilts = sharpen_number_of_tilts  # 0 is all the tilts of the stack
+        self.sharpen_dose_per_tilt = 0
+        self.sharpen_pre_dose = 0
+        self.sharpening_filter = None
+        self.sharpening_key = None  # (number of tilts, dose per tilt, pre dose) of the sharpening filter
+        self.banked_doses = set()  # the doses whose filters are kept in the filter bank
 
     # self.dose_weight()
 
     def dose_weight(self):
         np.seterr(divide='ignore')  # avoids a zero divide error printed in output.
-        print('Pre calculating frequency array ...')
+        hits, misses = filter_bank.hits, filter_bank.misses
         if not self.is_stack:
             img, self.header_apix = self.read_image(self.images[0])
         else:
@@ -219,54 +395,381 @@ class DoseWeight:
         if len(shape) != 2:
             print('Images must be 2D. Quitting...')
             sys.exit(2)
-        freq_array = self.create_frequency_array(shape, self.apix)
-        print('Frequency array created.')
+        self.fft_shape = shape if self.fft_padding == 'none' else fast_fft_shape(shape, (0, 1))
+        if self.fft_shape != shape:
+            print('Padding the images from %dx%d to %dx%d pixels for the FFTs.' % (shape[1], shape[0], self.fft_shape[1], self.fft_shape[0]))
+        fft_shape = self.fft_shape
+        self.spectrum_shape = (fft_shape[0], fft_shape[1] // 2 + 1) if self.half_spectrum else fft_shape
+        factors_key = ('exposure_factors', fft_shape, self.apix, self.half_spectrum, self.radial_lookup, self.float_dtype,
+                       self.a, self.b, self.c)
+        factors = filter_bank.get(factors_key, count=False)
+        if factors is None:
+            print('Pre calculating frequency array ...')
+            freq_array = self.create_frequency_array(fft_shape, self.apix, self.half_spectrum, self.float_dtype)
+            if not self.half_spectrum:
+                freq_array = self.fft_shift_filter(freq_array)  # so every filter made from it is already fft shifted
+            if self.radial_lookup:
+                radius_index, radial_freqs = self.create_radial_lookup(freq_array)
+                del freq_array
+                factors = (radius_index, self.create_exposure_factors(radial_freqs, self.a, self.b, self.c))
+            else:
+                factors = self.create_exposure_factors(freq_array, self.a, self.b, self.c, out=freq_array)
+            filter_bank.put(factors_key, factors)
+            print('Frequency array created.')
+        if self.radial_lookup:
+            self.radius_index, self.radial_factors = factors
+            exposure_factors = None
+        else:
+            exposure_factors = factors
+        if self.sharpen:
+            self.sharpening_key = (self.sharpen_number_of_tilts if self.sharpen_number_of_tilts > 0 else self.number_of_files,
+                                   self.sharpen_dose_per_tilt, self.sharpen_pre_dose)
+            self.sharpening_filter = self.cached_sharpening_filter(factors_key, self.radial_factors if self.radial_lookup else exposure_factors)
+        self.banked_doses = self.doses_to_bank(factors)
         if self.plot_filters != []:
             fig = plt.figure()
+        else:
+            fig = None
+        if self.is_stack and self.tilts is not None:
+            self.refilter_tilts(exposure_factors, fig)
+        elif self.is_stack:
+            self.dose_weight_stack(exposure_factors, fig)
+        else:
+            self.dose_weight_images(exposure_factors, shape, fig)
+        if filter_bank.max_memory > 0:
+            print('Filter bank: %d filters reused and %d calculated (%d and %d in this session). %d arrays cached in %.0f MB.' % (
+                filter_bank.hits - hits, filter_bank.misses - misses, filter_bank.hits, filter_bank.misses,
+                len(filter_bank.arrays), filter_bank.nbytes / 1024. ** 2))
+        if self.plot_filters != []:
+            plt.show()
+
+    def doses_to_bank(self, factors):
+        # The doses whose filters are kept in the filter bank. If the filters of all the doses do not fit next to the
+        # factors (and sharpening filter), only those of the first doses in stack order are kept. Otherwise, as the tilts
+        # are filtered in order, each filter would be dropped for a later one before the next stack could reuse it.
+        if filter_bank.max_memory <= 0:
+            return set()
+        room = filter_bank.max_memory * 1024 ** 3 - filter_bank.array_bytes(factors)
+        if self.sharpening_filter is not None:
+            room -= self.sharpening_filter.nbytes
+        number_of_filters = max(0, int(room // (np.prod(self.spectrum_shape) * np.dtype(filter_dtype).itemsize)))
+        doses = []
+        for dose in self.doses:
+            if float(dose) not in doses:
+                doses.append(float(dose))
+        if len(doses) > number_of_filters:
+            print('The filter bank (--filter_cache_memory) only has room for the filters of the first %d of the %d doses. Only those are kept.' % (
+                number_of_filters, len(doses)))
+        return set(doses[:number_of_filters])
+
+    def dose_weight_images(self, exposure_factors, shape, fig):
         for i, (image, dose) in enumerate(zip(self.images, self.doses)):
             print('Reading image %d of %d...' % (i + 1, self.number_of_files))
-            if not self.is_stack:
-                img, header_apix = self.read_image(image)
-            else:
-                img = image
+            img, header_apix = self.read_image(image)
             if img.shape != shape:
                 print('Image %d is not the expected size. Skipping...' % (i + 1))
                 continue
-            print('Creating filter array...')
-            filter_array = self.create_filter_array(dose, freq_array, self.a, self.b, self.c)
-            print('Filter array created.')
+            filter_array = self.batch_filter([dose], exposure_factors)[0]
             if i in self.plot_filters:
-                # plt.imshow(filter_array, cmap='gray')
-                # cbar = plt.colorbar()
-                scale_factor = 16
-                binned_filter_array = filter_array[::scale_factor, ::scale_factor]  # a crude resampling for the plot.
-                x = np.arange(0, binned_filter_array.shape[1])
-                y = np.arange(0, binned_filter_array.shape[0])
-                X, Y = np.meshgrid(x, y)
-                ax = fig.gca(projection='3d')
-                surf = ax.plot_surface(X, Y, binned_filter_array)
-            print('Overlaying filter...')
-            filter_array = self.fft_shift_filter(filter_array)
+                self.plot_filter(fig, self.unshift_filter(filter_array))
             filtered_image = self.overlay_filter(img, filter_array)
-            print('Image filtered.')
-            if not self.is_stack:
-                print('Saving image ...')
-                filename, file_extension = os.path.splitext(image)
-                outfile = filename + '_' + self.file_append + file_extension
-                out_apix = self.header_apix if keep_header_apix else self.apix
-                self.write_image(filtered_image, outfile, out_apix)
-                print('Image saved.')
-            else:
-                self.filtered_images[i] = filtered_image
-        if self.is_stack:
-            print('Saving stack ...')
-            filename, file_extension = os.path.splitext(self.files)
+            print('Saving image ...')
+            filename, file_extension = os.path.splitext(image)
             outfile = filename + '_' + self.file_append + file_extension
             out_apix = self.header_apix if keep_header_apix else self.apix
-            self.write_image(self.filtered_images, outfile, out_apix)
-            print('Stack saved.')
-        if self.plot_filters != []:
-            plt.show()
+            self.write_image(filtered_image, outfile, out_apix)
+            print('Image saved.')
+
+    def dose_weight_stack(self, exposure_factors, fig):
+        # Tilts are filtered in batches. The filters for a batch are a single 3D array (one plane per dose) and the
+        # whole batch is transformed with one FFT over the last two axes.
+        batch_size = self.batch_size if self.batch_size > 0 else self.batch_size_from_memory(self.fft_shape)
+        batch_size = min(batch_size, self.number_of_files)
+        outfile = output_path(self.files, self.file_append)
+        out_apix = self.header_apix if keep_header_apix else self.apix
+        self.open_binned_stacks()  # before the output is created, so a failure here leaves an earlier output as it was
+        if self.in_place:
+            self.write_in_place_marker()
+            out_mrc = self.in_mrc
+            out_mrc.voxel_size = out_apix
+            filtered_images = self.images
+            stats = None
+        elif self.streaming:
+            out_mrc = self.new_mmap_stack(outfile, self.images.shape, out_apix)
+            filtered_images = out_mrc.data
+            stats = None
+        else:
+            filtered_images = self.filtered_images
+        starts = range(0, self.number_of_files, batch_size)
+        concurrent_batches = 1 if self.pipeline else min(self.threads, len(starts))
+        self.fft_threads = max(1, self.threads // concurrent_batches)  # spare threads go to the FFT itself (pyfftw only)
+        print('Filtering %d images in batches of %d%s...' % (self.number_of_files, batch_size,
+              ' using %d threads' % self.threads if self.threads > 1 else ''))
+        if self.pipeline:
+            stats = self.pipelined_dose_weight_stack(starts, batch_size, exposure_factors, filtered_images, fig)
+            results = []
+            pool = None
+        elif concurrent_batches > 1:
+            pool = multiprocessing.pool.ThreadPool(concurrent_batches)
+            results = pool.imap(lambda start: self.filter_batch(start, batch_size, exposure_factors, filtered_images, fig), starts)
+        else:
+            pool = None
+            results = (self.filter_batch(start, batch_size, exposure_factors, filtered_images, fig) for start in starts)
+        for start, stop, batch_stats in results:
+            print('Filtered images %d to %d of %d.' % (start + 1, stop, self.number_of_files))
+            if self.streaming:
+                stats = update_stats(stats, batch_stats)
+                filtered_images.flush()
+                self.release_mmap_pages(self.images)
+                self.release_mmap_pages(filtered_images)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        print('Saving stack ...')
+        if self.in_place:
+            set_header_stats(out_mrc, stats)
+            out_mrc.close()
+            os.remove(self.files + in_place_marker_suffix)  # only once every tilt (and the header) is on disk
+        elif self.streaming:
+            set_header_stats(out_mrc, stats)
+            out_mrc.close()
+            self.in_mrc.close()
+        else:
+            self.write_image(filtered_images, outfile, out_apix)
+        self.close_binned_stacks(batch_size)
+        print('Stack saved.')
+
+    def refilter_tilts(self, exposure_factors, fig):
+        # Filters only the tilts in self.tilts and writes them over the same tilts of the existing output stack.
+        # The header stats are then recalculated from the whole output stack.
+        batch_size = self.batch_size if self.batch_size > 0 else self.batch_size_from_memory(self.fft_shape)
+        batch_size = min(batch_size, len(self.tilts))
+        out_mrc = mrcfile.mmap(output_path(self.files, self.file_append), mode='r+')
+        filtered_images = out_mrc.data
+        self.open_binned_stacks(existing=True)
+        print('Filtering %d of the %d images in batches of %d...' % (len(self.tilts), self.number_of_files, batch_size))
+        for i in range(0, len(self.tilts), batch_size):
+            tilts = self.tilts[i:i + batch_size]
+            filter_array = self.batch_filter([self.doses[tilt] for tilt in tilts], exposure_factors)
+            for tilt, tilt_filter in zip(tilts, filter_array):
+                if tilt in self.plot_filters:
+                    self.plot_filter(fig, self.unshift_filter(tilt_filter))
+            filtered_images[tilts] = self.overlay_filter(self.images[tilts], filter_array, self.bin_spectrum(tilts))
+            del filter_array
+            print('Filtered images %s.' % ', '.join(str(tilt + 1) for tilt in tilts))
+        print('Saving stack ...')
+        set_header_stats(out_mrc, self.stack_stats(filtered_images, batch_size))
+        out_mrc.close()
+        self.in_mrc.close()
+        self.close_binned_stacks(batch_size)
+        print('Stack saved.')
+
+    def open_binned_stacks(self, existing=False):
+        # A binned copy of the stack (filtered False) and of the dose weighted stack (filtered True) for each binning
+        # factor. existing opens the ones from an earlier run to update some of their tilts.
+        if keep_header_apix:
+            apix = (float(self.header_apix.x), float(self.header_apix.y), float(self.header_apix.z))
+        else:
+            apix = (self.apix,) * 3
+        for factor in self.binning:
+            shape = (self.number_of_files, self.images.shape[1] // factor, self.images.shape[2] // factor)
+            for filtered in (False, True):
+                path = binned_output_path(self.files, self.file_append, factor, filtered)
+                if existing:
+                    self.binned_stacks[(factor, filtered)] = mrcfile.mmap(path, mode='r+')
+                else:
+                    binned_apix = (apix[0] * factor, apix[1] * factor, apix[2])
+                    self.binned_stacks[(factor, filtered)] = self.new_mmap_stack(path, shape, binned_apix)
+        if self.binning != []:
+            print('Writing stacks binned by %s in Fourier space.' % ', '.join(str(factor) for factor in self.binning))
+
+    def bin_spectrum(self, tilts):
+        # The spectrum_callback for overlay_filter that writes the binned images of these tilts (a slice or a list of
+        # indices) from the spectra of the batch. None if there are no binned outputs.
+        if self.binned_stacks == {}:
+            return None
+
+        def write_binned(spectrum, filtered):
+            image_shape = spectrum.shape[:-1] + self.images.shape[-1:]
+            for factor in self.binning:
+                binned = fourier_bin(spectrum, image_shape, factor, (1, 2), self.half_spectrum)
+                self.binned_stacks[(factor, filtered)].data[tilts] = binned
+        return write_binned
+
+    def close_binned_stacks(self, batch_size):
+        for mrc in self.binned_stacks.values():
+            set_header_stats(mrc, self.stack_stats(mrc.data, batch_size))
+            mrc.close()
+        self.binned_stacks = {}
+
+    def stack_stats(self, data, batch_size):
+        # The stats of a whole (memory mapped) stack, batch_size tilts at a time.
+        stats = None
+        for start in range(0, data.shape[0], batch_size):
+            stats = update_stats(stats, data[start:start + batch_size])
+        return stats
+
+    def manifest_settings(self):
+        # Everything other than the doses that changes the filtered images.
+        return {'apix': self.apix, 'a': self.a, 'b': self.b, 'c': self.c, 'half_spectrum': self.half_spectrum,
+                'radial_lookup': self.radial_lookup, 'single_precision': self.single_precision,
+                'fft_padding': self.fft_padding, 'keep_header_apix': keep_header_apix, 'binning': self.binning,
+                'sharpen': [self.sharpen_number_of_tilts, self.sharpen_dose_per_tilt, self.sharpen_pre_dose] if self.sharpen else None}
+
+    def binned_fingerprints(self):
+        paths = [binned_output_path(self.files, self.file_append, factor, filtered) for factor in self.binning for filtered in (False, True)]
+        return [file_fingerprint(path) if os.path.isfile(path) else None for path in paths]
+
+    def changed_tilts(self, manifest):
+        # The tilts whose dose is not the one in the manifest (or all of them if any of the settings changed).
+        if (manifest.get('settings') != self.manifest_settings() or len(manifest.get('doses', [])) != self.number_of_files
+                or manifest.get('binned', []) != self.binned_fingerprints()):
+            return list(range(self.number_of_files))
+        return [i for i, (dose, old_dose) in enumerate(zip(self.doses, manifest['doses'])) if float(dose) != old_dose]
+
+    def write_manifest(self, outfile):
+        manifest = {'input': file_fingerprint(self.files), 'output': file_fingerprint(outfile),
+                    'settings': self.manifest_settings(), 'doses': [float(dose) for dose in self.doses],
+                    'binned': self.binned_fingerprints()}
+        temp_file = '%s%s.%d' % (outfile, manifest_suffix, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(temp_file, outfile + manifest_suffix)
+
+    def filter_batch(self, start, batch_size, exposure_factors, filtered_images, fig):
+        # Filters one batch of tilts into filtered_images. Batches can run at the same time on a thread pool as the
+        # FFTs and the large numpy operations release the GIL.
+        stop = min(start + batch_size, self.number_of_files)
+        filtered_batch = self.filter_images(self.images[start:stop], start, exposure_factors, fig)
+        filtered_images[start:stop] = filtered_batch
+        batch_stats = update_stats(None, filtered_batch) if self.streaming else None
+        return start, stop, batch_stats
+
+    def filter_images(self, images, start, exposure_factors, fig):
+        # Filters a batch of tilts (the first being tilt number start in the stack) and returns the filtered batch.
+        stop = start + images.shape[0]
+        filter_array = self.batch_filter(self.doses[start:stop], exposure_factors)
+        for i in range(start, stop):
+            if i in self.plot_filters:
+                self.plot_filter(fig, self.unshift_filter(filter_array[i - start]))
+        filtered_batch = self.overlay_filter(images, filter_array, self.bin_spectrum(slice(start, stop)))
+        del filter_array
+        return filtered_batch
+
+    def batch_filter(self, doses, exposure_factors):
+        # The filters for a list of doses as one 3D array, ready to multiply the spectra with (ie already fft shifted).
+        # It is a view of this thread's workspace so it is only valid until the thread's next batch. Filters in the
+        # filter bank are copied from there and only the others are calculated (and added to it if banked_doses has room).
+        filter_array = filter_workspace.get((len(doses),) + self.spectrum_shape, filter_dtype)
+        for i, dose in enumerate(doses):
+            key = ('filter', self.fft_shape, self.apix, float(dose), self.half_spectrum, self.radial_lookup,
+                   self.float_dtype, self.a, self.b, self.c, self.sharpening_key)
+            cached_filter = filter_bank.get(key) if filter_bank.max_memory > 0 else None
+            if cached_filter is not None:
+                filter_array[i] = cached_filter
+            else:
+                self.create_filter(float(dose), exposure_factors, out=filter_array[i])
+                if float(dose) in self.banked_doses:
+                    filter_bank.put(key, filter_array[i].copy())  # a copy as the workspace is overwritten by the next batch
+        return filter_array
+
+    def pipelined_dose_weight_stack(self, starts, batch_size, exposure_factors, filtered_images, fig):
+        # Three stages joined by bounded queues. A prefetch thread reads batch i+1 and a write behind thread writes
+        # batch i-1 while batch i is filtered here. Returns the stats of the filtered stack.
+        read_queue = queue.Queue(maxsize=pipeline_queue_depth)
+        write_queue = queue.Queue(maxsize=pipeline_queue_depth)
+        timings = {'read': 0., 'filter': 0., 'write': 0.}
+        errors = []  # exceptions raised in the background threads
+        stats = [None]
+
+        def read_batches():
+            try:
+                for start in starts:
+                    if errors:
+                        break
+                    stop = min(start + batch_size, self.number_of_files)
+                    t = time.time()
+                    images = np.array(self.images[start:stop])  # forces the read from the memory map
+                    self.release_mmap_pages(self.images)
+                    timings['read'] += time.time() - t
+                    read_queue.put((start, stop, images))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                read_queue.put(None)
+
+        def write_batches():
+            while True:
+                batch = write_queue.get()
+                if batch is None:
+                    return
+                if errors:
+                    continue  # keep emptying the queue so the filtering never blocks
+                start, stop, filtered_batch = batch
+                try:
+                    t = time.time()
+                    filtered_images[start:stop] = filtered_batch
+                    filtered_images.flush()
+                    self.release_mmap_pages(filtered_images)
+                    timings['write'] += time.time() - t
+                    stats[0] = update_stats(stats[0], filtered_batch)
+                    print('Filtered images %d to %d of %d.' % (start + 1, stop, self.number_of_files))
+                except Exception as e:
+                    errors.append(e)
+
+        start_time = time.time()
+        reader = threading.Thread(target=read_batches)
+        writer = threading.Thread(target=write_batches)
+        for thread in (reader, writer):
+            thread.daemon = True  # so that an error here never leaves the program waiting on them
+            thread.start()
+        try:
+            while not errors:
+                batch = read_queue.get()
+                if batch is None:
+                    break
+                start, stop, images = batch
+                t = time.time()
+                filtered_batch = self.filter_images(images, start, exposure_factors, fig)
+                timings['filter'] += time.time() - t
+                write_queue.put((start, stop, filtered_batch))
+        finally:
+            write_queue.put(None)
+        writer.join()
+        if errors:
+            raise errors[0]
+        reader.join()
+        total_time = time.time() - start_time
+        io_time = timings['read'] + timings['write']
+        hidden_time = min(io_time, max(0., timings['read'] + timings['filter'] + timings['write'] - total_time))
+        print('Pipeline: %.2f s reading, %.2f s filtering and %.2f s writing took %.2f s. %.2f s of the %.2f s of I/O was hidden (%d%%).' % (
+            timings['read'], timings['filter'], timings['write'], total_time, hidden_time, io_time,
+            100 * hidden_time / io_time if io_time > 0 else 0))
+        return stats[0]
+
+    def batch_size_from_memory(self, shape):
+        # Rough peak memory per tilt in a batch: the input and output images, the filter, the spectrum and the
+        # filtered spectrum.
+        spectrum_shape = (shape[0], shape[1] // 2 + 1) if self.half_spectrum else shape
+        image_pixels = shape[0] * shape[1]
+        spectrum_pixels = spectrum_shape[0] * spectrum_shape[1]
+        float_bytes = 4 if self.single_precision else 8
+        bytes_per_tilt = (image_pixels * 2 * 4) + (spectrum_pixels * np.dtype(filter_dtype).itemsize) + (spectrum_pixels * 2 * 2 * float_bytes)
+        if self.pipeline:  # batches waiting in (or being taken from and put in) the two queues
+            bytes_per_tilt += image_pixels * 4 * 2 * (pipeline_queue_depth + 1)
+        return max(1, int((self.batch_memory * 1024 ** 3) // (bytes_per_tilt * self.threads)))  # each thread holds a batch
+
+    def plot_filter(self, fig, filter_array):
+        # plt.imshow(filter_array, cmap='gray')
+        # cbar = plt.colorbar()
+        scale_factor = 16
+        binned_filter_array = filter_array[::scale_factor, ::scale_factor]  # a crude resampling for the plot.
+        x = np.arange(0, binned_filter_array.shape[1])
+        y = np.arange(0, binned_filter_array.shape[0])
+        X, Y = np.meshgrid(x, y)
+        ax = fig.gca(projection='3d')
+        surf = ax.plot_surface(X, Y, binned_filter_array)
+        return surf
 
     def read_image(self, image):
         with mrcfile.open(image) as mrc:
@@ -279,46 +782,198 @@ class DoseWeight:
             mrc.voxel_size = apix
             mrc.close()
 
-    def create_frequency_array(self, shape, apix):
-        freq_array = np.zeros(shape)
+    def new_mmap_stack(self, path, shape, apix=1):
+        # The file is created at its full size without writing any data. It is filled in batch by batch.
+        mrc = mrcfile.new_mmap(path, shape, mrc_mode=2, overwrite=True)
+        mrc.set_image_stack()
+        mrc.voxel_size = apix
+        return mrc
+
+    def write_in_place_marker(self):
+        # Written (and synced) before any tilt is overwritten, and removed once the stack is finished. If it is still
+        # there the stack is a mix of filtered and unfiltered tilts.
+        with open(self.files + in_place_marker_suffix, 'w') as f:
+            f.write('Dose weighting %s in place (started %s).\n' % (self.files, time.strftime('%Y-%m-%d %H:%M:%S')))
+            f.write('Doses: %s\n' % ','.join(str(dose) for dose in self.doses))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def release_mmap_pages(self, array):
+        # Drops the pages of a memory mapped array from this process. They stay in the page cache (and on disk) but
+        # no longer count towards its memory use. (needs python 3.8+, otherwise the kernel drops them when it needs to)
+        mmap_object = getattr(array, '_mmap', None)
+        if mmap_object is not None and hasattr(mmap_object, 'madvise'):
+            mmap_object.madvise(mmap.MADV_DONTNEED)
+
+    def create_frequency_array(self, shape, apix, half_spectrum=False, dtype='float64'):
         xsize = shape[1]
         ysize = shape[0]
-        xcen = (
-        xsize / 2)  # Brigg's center for array is half the image size +1 pix. I removed the 1 as didn't match with fft.
-        ycen = (ysize / 2)
-        xrstep = 1 / (xsize * apix)  # reciprocal pixel size
-        yrstep = 1 / (ysize * apix)
-        x, y = np.mgrid[0:ysize, 0:xsize]
-        freq_array = np.sqrt(((xrstep * (x - xcen)) ** 2) + ((yrstep * (y - ycen)) ** 2))
-        return freq_array
+        if half_spectrum:
+            # Already in fft order (zero frequency at [0, 0]) and only the x frequencies kept by rfft2.
+            x = np.fft.rfftfreq(xsize, apix)
+            y = np.fft.fftfreq(ysize, apix)
+        else:
+            xcen = xsize // 2  # Brigg's center for array is half the image size +1 pix. I removed the 1 as didn't match with fft.
+            ycen = ysize // 2
+            xrstep = 1. / (xsize * apix)  # reciprocal pixel size
+            yrstep = 1. / (ysize * apix)
+            x = xrstep * (np.arange(xsize) - xcen)
+            y = yrstep * (np.arange(ysize) - ycen)
+        x = x.astype(dtype)  # the axes are always calculated in double precision
+        y = y.astype(dtype)
+        freq_array = np.add(x[np.newaxis, :] ** 2, y[:, np.newaxis] ** 2)
+        return np.sqrt(freq_array, out=freq_array)
 
     def fft_shift_filter(self, filter_array):
-        filter_array = np.fft.ifftshift(filter_array)
+        filter_array = np.fft.ifftshift(filter_array, axes=(-2, -1))
         return filter_array
 
-    def create_filter_array(self, dose, freq_array, a, b, c):
-        # q = exp((-dose)./(2.*((a.*(freq_array.^b))+c)));
-        q = np.exp(np.divide(-dose, np.multiply(np.add(np.multiply(np.power(freq_array, b), a), c), 2)))
+    def unshift_filter(self, filter_array):
+        # back to the centred filter (for plotting)
+        return filter_array if self.half_spectrum else np.fft.fftshift(filter_array, axes=(-2, -1))
+
+    def create_radial_lookup(self, freq_array):
+        # The filter only depends on the spatial frequency so it can be calculated once per radial bin and
+        # expanded to the full image with an integer map of the bin of each pixel.
+        bin_width = freq_array.max() / (radial_lookup_bins - 1)
+        radius_index = np.rint(freq_array / bin_width).astype('int32')
+        radial_freqs = (np.arange(0, radius_index.max() + 1) * float(bin_width)).astype(freq_array.dtype)
+        return radius_index, radial_freqs
+
+    def create_filter(self, dose, exposure_factors, out=None):
+        # With --sharpen the filter is multiplied by the sharpening filter (a radial profile with --radial_lookup).
+        if self.radial_lookup:
+            return self.create_filter_array_from_lookup(dose, self.radius_index, self.radial_factors, out)
+        q = self.create_filter_array(dose, exposure_factors, out)
+        if self.sharpening_filter is not None:
+            q *= self.sharpening_filter
         return q
 
-    def overlay_filter(self, img, filter_array):
-        axes = (0, 1)
+    def create_filter_array_from_lookup(self, dose, radius_index, radial_factors, out=None):
+        radial_profile = self.create_filter_array(dose, radial_factors)
+        if self.sharpening_filter is not None:
+            radial_profile *= self.sharpening_filter
+        return np.take(radial_profile, radius_index, out=out, mode='clip')  # clip (the indices are all valid) as raise buffers out
+
+    def create_exposure_factors(self, freq_array, a, b, c, out=None):
+        # The dose independent part of the filter, -1/(2*(a*freq^b + c)), so that the filter for a dose is just
+        # exp(dose * factors). Calculated in place (in out, which can be freq_array itself).
+        factors = np.power(freq_array, b, out=out)
+        factors *= a
+        factors += c
+        factors *= 2
+        return np.divide(-1, factors, out=factors)
+
+    def cached_sharpening_filter(self, factors_key, exposure_factors):
+        number_of_tilts = self.sharpening_key[0]
+        key = ('sharpening',) + self.sharpening_key + factors_key
+        sharpening_filter = filter_bank.get(key, count=False)
+        if sharpening_filter is None:
+            print('Calculating the sharpening filter for %d tilts of %g e-/A^2 after %g e-/A^2 ...' % (
+                number_of_tilts, self.sharpen_dose_per_tilt, self.sharpen_pre_dose))
+            sharpening_filter = self.create_sharpening_filter(exposure_factors, self.sharpen_dose_per_tilt, self.sharpen_pre_dose, number_of_tilts)
+            filter_bank.put(key, sharpening_filter)
+        return sharpening_filter
+
+    def create_sharpening_filter(self, exposure_factors, dose_per_tilt, pre_dose, number_of_tilts):
+        # The filter of tomo_doseweight_sharpen, 1/q with q = exp(t*(dose_per_tilt+pre_dose)) * (1-exp(t*dose_per_tilt*number_of_tilts)) / (number_of_tilts*(1-exp(t*dose_per_tilt)))
+        # where t is the exposure factors. 1 - exp(x) is calculated as -expm1(x) to keep its precision at low frequencies.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            numerator = np.expm1(np.multiply(exposure_factors, dose_per_tilt))
+            numerator *= number_of_tilts
+            denominator = np.expm1(np.multiply(exposure_factors, dose_per_tilt * number_of_tilts))
+            denominator *= np.exp(np.multiply(exposure_factors, dose_per_tilt + pre_dose))
+            sharpening_filter = np.divide(numerator, denominator, out=numerator)
+        del denominator
+        sharpening_filter[np.isnan(sharpening_filter)] = 1  # zero frequency (0/0)
+        return sharpening_filter
+
+    def create_filter_array(self, dose, exposure_factors, out=None):
+        # q = exp((-dose)./(2.*((a.*(freq_array.^b))+c)));
+        q = np.multiply(exposure_factors, dose, out=out)
+        return np.exp(q, out=q)
+
+    def overlay_filter(self, img, filter_array, spectrum_callback=None):
+        # spectrum_callback(spectrum, filtered) is given the (unpadded) spectrum before and after the filter.
+        axes = (img.ndim - 2, img.ndim - 1)  # a 3D img is a batch of images
+        if self.fft_padding == 'none' or img.shape[-2:] == self.fft_shape:
+            return self.overlay_filter_at_size(img, filter_array, axes, spectrum_callback)
+        padded_img = pad_image(img, img.shape[:-2] + self.fft_shape, axes, self.fft_padding)
+        return crop_image(self.overlay_filter_at_size(padded_img, filter_array, axes), img.shape)
+
+    def overlay_filter_at_size(self, img, filter_array, axes, spectrum_callback=None):
         if use_pyfftw:
-            fft_func = pyfftw.interfaces.numpy_fft.fft2
-            ifft_func = pyfftw.interfaces.numpy_fft.ifft2
-            pyfftw.interfaces.cache.enable()
+            return fftw_plans.overlay_filter(img, filter_array, axes, self.half_spectrum, self.fft_threads, self.single_precision,
+                                             spectrum_callback)
+        if self.half_spectrum:
+            fft = np.fft.rfft2(img, axes=axes)
+            if spectrum_callback is not None:
+                spectrum_callback(fft, False)
+            np.multiply(fft, filter_array, out=fft)
+            if spectrum_callback is not None:
+                spectrum_callback(fft, True)
+            filtered_img = np.fft.irfft2(fft, s=img.shape[-2:], axes=axes).astype('float32')
         else:
-            fft_func = np.fft.fft2
-            ifft_func = np.fft.ifft2
-        filtered_img = np.real(ifft_func(np.multiply(fft_func(img, axes=axes), filter_array), axes=axes)).astype('float32')
-        if use_pyfftw:
-            pyfftw.interfaces.cache.disable()
+            fft = np.fft.fft2(img, axes=axes)
+            if spectrum_callback is not None:
+                spectrum_callback(fft, False)
+            np.multiply(fft, filter_array, out=fft)
+            if spectrum_callback is not None:
+                spectrum_callback(fft, True)
+            filtered_img = np.real(np.fft.ifft2(fft, axes=axes)).astype('float32')
         return filtered_img
 
 
+def output_path(stack, file_append):
+    filename, file_extension = os.path.splitext(stack)
+    return filename + '_' + file_append + file_extension
+
+
+def binned_output_path(stack, file_append, factor, filtered):
+    filename, file_extension = os.path.splitext(stack)
+    return '%s%s_bin%d%s' % (filename, '_' + file_append if filtered else '', factor, file_extension)
+
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def read_manifest(outfile):
+    # The manifest of an output stack, or None if there is none or the input or output stack changed since.
+    path = outfile + manifest_suffix
+    if not os.path.isfile(path) or not os.path.isfile(outfile):
+        return None
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        print('Could not read %s. Ignoring it.' % path)
+        return None
+    if manifest.get('output') != file_fingerprint(outfile):
+        return None
+    return manifest
+
+
 def tilt_series_dose_weight(tilt_series, dose_per_tilt, file_append, apix, plot_filters, tilt_scheme, min_angle,
-                            angle_step, do_not_do_dose_weighting, custom_dose_series, pre_dose, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered):
-    dw = DoseWeight(tilt_series, [], apix, file_append, plot_filters)
+                            angle_step, do_not_do_dose_weighting, custom_dose_series, pre_dose, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered,
+                            force=False, **dose_weight_kwargs):
+    if os.path.isfile(tilt_series + in_place_marker_suffix):
+        print('%s was not finished being dose weighted in place (found %s) so some of its tilts are already filtered. Restore it from the original data and remove that file. Skipping...' % (
+            tilt_series, tilt_series + in_place_marker_suffix))
+        return False
+    use_manifest = not dose_weight_kwargs.get('in_place', False)  # an in place stack has no separate output
+    outfile = output_path(tilt_series, file_append)
+    manifest = read_manifest(outfile) if use_manifest and not force else None
+    if manifest is not None and manifest.get('input') != file_fingerprint(tilt_series):
+        manifest = None
+    if manifest is not None:
+        dose_weight_kwargs = dict(dose_weight_kwargs, streaming=True)  # so only the tilts that changed (if any) are read
+    dw = DoseWeight(tilt_series, [], apix, file_append, plot_filters, **dose_weight_kwargs)
+    if dw.in_place and dw.images.dtype != np.float32:
+        print('%s is not float32 (mode 2) so it can not be dose weighted in place. Skipping...' % tilt_series)
+        dw.in_mrc.close()
+        return False
     if custom_dose_series == None:
         total_tilts = dw.number_of_files
         order_list = tilt_order_from_tilt_scheme(tilt_scheme, min_angle, angle_step, total_tilts, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered)
@@ -328,22 +983,104 @@ def tilt_series_dose_weight(tilt_series, dose_per_tilt, file_append, apix, plot_
         doses = [float(dose) for dose in doses]
         if len(doses) != dw.number_of_files:
             print('Not the correct number of entries in the dose list. Skipping...')
-            return
+            return False
     print('The following doses are used for dose weighting each tilt image: %s' % (str(doses)))
     dw.doses = doses
+    dw.sharpen_dose_per_tilt, dw.sharpen_pre_dose = dose_per_tilt, pre_dose
     if do_not_do_dose_weighting == False:
+        if manifest is not None:
+            tilts = dw.changed_tilts(manifest)
+            if tilts == []:
+                print('%s is up to date (same stack, doses and settings). Skipping...' % outfile)
+                dw.in_mrc.close()
+                return True
+            if len(tilts) < dw.number_of_files:
+                print('Only the doses of tilts %s changed since %s was written.' % (', '.join(str(tilt + 1) for tilt in tilts), outfile))
+                dw.tilts = tilts
+        if use_manifest and os.path.isfile(outfile + manifest_suffix):
+            os.remove(outfile + manifest_suffix)  # so an output left half written is never taken as up to date
         dw.dose_weight()
+        if use_manifest:
+            dw.write_manifest(outfile)
     else:
         print('Skipping actually doing the dose weighting as --do_not_do_dose_weighting set')
-        return
+    return True
 
 
 def main(tilt_series, dose_per_tilt, file_append, apix, plot_filters, tilt_scheme, min_angle, angle_step,
-         do_not_do_dose_weighting, custom_dose_series, pre_dose, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered):
+         do_not_do_dose_weighting, custom_dose_series, pre_dose, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered,
+         jobs=1, threads=1, filter_cache_memory=default_filter_cache_memory, **dose_weight_kwargs):
     tilt_series = sorted(glob.glob(tilt_series))
-    for stack in tilt_series:
-        tilt_series_dose_weight(stack, dose_per_tilt, file_append, apix, plot_filters, tilt_scheme, min_angle,
-                                angle_step, do_not_do_dose_weighting, custom_dose_series, pre_dose, starting_tilt_angle,dose_symmetric_group_size,dose_symmetric_groups_not_centered)
+    jobs = min(jobs, len(tilt_series))
+    dose_weight_kwargs['threads'] = threads_per_job(jobs, threads)
+    dose_weight_kwargs['filter_cache_memory'] = filter_cache_memory_per_job(len(tilt_series), jobs, filter_cache_memory)
+    dose_weight_args = (dose_per_tilt, file_append, apix, plot_filters, tilt_scheme, min_angle, angle_step, do_not_do_dose_weighting,
+                        custom_dose_series, pre_dose, starting_tilt_angle, dose_symmetric_group_size, dose_symmetric_groups_not_centered)
+    if jobs > 1 and len(tilt_series) > 1:
+        parallel_tilt_series_dose_weight(tilt_series, jobs, dose_weight_args, dose_weight_kwargs)
+    else:
+        for stack in tilt_series:
+            tilt_series_dose_weight(stack, *dose_weight_args, **dose_weight_kwargs)
+
+
+def threads_per_job(jobs, threads):
+    # Keeps jobs * threads within the number of cores. threads <= 0 shares all the cores between the jobs.
+    cpus = multiprocessing.cpu_count()
+    max_threads = max(1, cpus // max(jobs, 1))
+    if threads <= 0:
+        threads = max_threads
+    elif threads > max_threads:
+        print('Reducing --threads from %d to %d so that %d jobs do not use more than the %d available cores.' % (threads, max_threads, jobs, cpus))
+        threads = max_threads
+    return threads
+
+
+def filter_cache_memory_per_job(number_of_stacks, jobs, filter_cache_memory):
+    # The filter bank only pays off once a job dose weights a second stack, so it is off if no job has more than one.
+    # filter_cache_memory is the budget for the node so it is split between the jobs.
+    if number_of_stacks <= max(jobs, 1):
+        return 0
+    return filter_cache_memory / float(max(jobs, 1))
+
+
+def logged_tilt_series_dose_weight(job):
+    # Runs in a worker process. The output is collected so it can be printed in order once the stack is done.
+    stack, dose_weight_args, dose_weight_kwargs = job
+    stdout = sys.stdout
+    sys.stdout = log = StringIO()
+    error = None
+    try:
+        if not tilt_series_dose_weight(stack, *dose_weight_args, **dose_weight_kwargs):
+            error = log.getvalue()
+    except (Exception, SystemExit):
+        error = traceback.format_exc()
+        print(error)
+    finally:
+        sys.stdout = stdout
+    return stack, log.getvalue(), error
+
+
+def parallel_tilt_series_dose_weight(tilt_series, jobs, dose_weight_args, dose_weight_kwargs):
+    print('Dose weighting %d tilt series using %d processes...' % (len(tilt_series), jobs))
+    job_list = [(stack, dose_weight_args, dose_weight_kwargs) for stack in tilt_series]
+    failed = []
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for i, (stack, log, error) in enumerate(pool.imap(logged_tilt_series_dose_weight, job_list)):
+            print('########## Tilt series %d of %d: %s ##########' % (i + 1, len(tilt_series), stack))
+            print(log.rstrip('\n'))
+            sys.stdout.flush()
+            if error is not None:
+                failed.append((stack, error.strip().split('\n')[-1]))
+    finally:
+        pool.close()
+        pool.join()
+    if failed != []:
+        print('Dose weighting failed for %d of %d tilt series:' % (len(failed), len(tilt_series)))
+        for stack, error in failed:
+            print('    %s: %s' % (stack, error))
+    else:
+        print('All %d tilt series dose weighted.' % len(tilt_series))
 
 
 if __name__ == "__main__":
@@ -352,7 +1089,13 @@ if __name__ == "__main__":
     argparser.validate(args)
 
     main(args.tilt_series, args.dose_per_tilt, args.file_append, args.pixel_size, plot_filters, args.tilt_scheme,
-         args.min_angle, args.angle_step, args.do_not_do_dose_weighting, args.custom_dose_series, args.pre_dose, args.starting_angle,args.dose_symmetric_group_size, args.dose_symmetric_groups_not_centered)
+         args.min_angle, args.angle_step, args.do_not_do_dose_weighting, args.custom_dose_series, args.pre_dose, args.starting_angle,args.dose_symmetric_group_size, args.dose_symmetric_groups_not_centered,
+         half_spectrum=args.half_spectrum, batch_size=args.batch_size, batch_memory=args.batch_memory,
+         jobs=args.jobs, threads=args.threads, radial_lookup=args.radial_lookup, streaming=args.streaming,
+         pipeline=args.pipeline, single_precision=args.single_precision, filter_cache_memory=args.filter_cache_memory,
+         fft_padding=args.fft_padding, in_place=args.in_place, force=args.force, fftw_planning=args.fftw_planning,
+         sharpen=args.sharpen, sharpen_number_of_tilts=args.sharpen_number_of_tilts,
+         binning=[int(factor) for factor in args.binned_outputs.split(',')] if args.binned_outputs != '' else [])
 
 
 
@@ -6,6 +6,18 @@ import sys
 import os
 import glob
 import argparse
+import csv
+import collections
+import hashlib
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+import multiprocessing.pool
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 use_pfftw = True # This provides a faster FFT than the standard numpy version. It is optional.
@@ -15,6 +27,10 @@ if use_pfftw:
     except ImportError:
         print('Cannot find pyfftw module. Install this to get faster FFTs!')
         use_pfftw = False
+if use_pfftw:
+    from tomo_fft import fftw_plans
+from tomo_fft import fft_padding_modes, fast_fft_shape, pad_image, crop_image, fftw_planning_efforts, default_fftw_planning, fftw_wisdom_file
+from tomo_fft import update_stats, set_header_stats
 
 class ArgumentParser():
     def __init__(self):
@@ -28,7 +44,7 @@ class ArgumentParser():
         addr('-i', '--input_map', required=True, help='A wild card expression (IN QUOTES!) to the mrc maps that you want to sharpen. (also works on 2d images/stacks).')
         addr('--number_of_tilts', type=int, help='The number of tilts included in the reconstruction. This can be less than the total number collected so long as those removed were the last to be collected.')
         addr('-dose', '--dose_per_tilt', type=float, help='Dose applied per tilt image. (in e-/A^2)')
-        add('--all_inputs_equal', action='store_true', help='Set this option if all input maps are equal (in size and pixel size). Arrays are precalculated to speed things up!')
+        add('--all_inputs_equal', action='store_true', help='Set this option if all input maps are equal (in size and pixel size). Their headers are then not checked. (otherwise the maps are grouped by their size, pixel size and doses and the arrays are precalculated once for each group)')
 
         add('-apix', '--pixel_size', type=float, help='The pixel size of the images in angstrom. If not supplied, apix is read from the header.')
         add('--pre_dose', default=0, type=float, help='Initial dose before tilt series collected.')
@@ -37,6 +53,19 @@ class ArgumentParser():
         add('--do_not_do_dose_weighting', action='store_true', help='Set this to just check the files and not actually apply dose weighting.')
         add('--interpret_as_slices', action='store_true', help='Force interpreting a 3d volume as a 2d image stack')
         add('--interpret_as_images', action='store_true', help='Force interpreting a stack of 2d images as a 3d volume')
+        add('--fft_padding', default='none', choices=fft_padding_modes, help='Pad the images (or volumes) to the next size with no prime factors above 7 before the FFT (and crop them back after). The padding is the mean of the edge pixels (edge_mean) or a mirror image of the edge (mirror). Faster for awkward sizes.')
+        add('--half_spectrum', action='store_true', help='Use a real to complex FFT (rfftn) with a filter covering only half of the spectrum. This roughly halves the FFT time and the memory used by the spectrum and the filter (most useful for volumes).')
+        add('--single_precision', action='store_true', help='Calculate the filter and FFTs in single precision (float32/complex64). Halves the memory used and moved. The result differs from the double precision one by less than 1e-5 of the image RMS (mean included, as the complex64 rounding error scales with the pixel values rather than their spread).')
+        add('--filter_cache_size', type=float, default=default_filter_cache_size, help='Disk space (in GB) for keeping calculated filters as .npy files in --filter_cache_dir, so later runs with the same map size, pixel size and doses load them instead. The least recently used are deleted first. 0 (the default) turns this off. A filter is about 4 bytes per voxel of the map (half that with --half_spectrum).')
+        add('--filter_cache_dir', type=str, default=default_filter_cache_dir, help='The directory of the filter cache (see --filter_cache_size).')
+        add('--fftw_planning', default=default_fftw_planning, choices=fftw_planning_efforts, help='How hard FFTW (pyfftw) looks for a fast plan for each new image shape. estimate plans at once. measure and above can find faster plans but take seconds to minutes per shape (and per batch size) the first time. Their plans are saved in %s so later runs reuse them.' % fftw_wisdom_file)
+        add('--per_file_values', type=str, default=None, help='A CSV file (with a header line) or a star file with a "file" column and any of "number_of_tilts", "dose_per_tilt" and "pre_dose" columns (_number_of_tilts etc in a star file). These override the values given above for those maps.')
+        add('--jobs', type=int, default=1, help='The number of maps to sharpen at the same time (each in its own process). The maps of all the groups (see --all_inputs_equal) share one pool, and the workers share the precalculated filter of each group.')
+        add('--batch_size', type=int, default=1, help='Single images or volumes (eg subtomograms) of the same size, pixel size and doses (one group, see --all_inputs_equal) are sharpened this many at a time with one batched FFT. Use eg 100s for small subtomograms. Batched groups do not use --jobs.')
+        add('--io_threads', type=int, default=default_io_threads, help='The number of threads reading and writing the maps of the next and previous --batch_size batches while one is sharpened.')
+        add('--out_of_core', action='store_true', help='Sharpen single volumes without loading them into memory. The 3D FFT is done in slabs through a memory mapped scratch file (as big as the volume, or twice that in double precision). For tomograms larger than the memory. With --in_place the volumes must be float32 (mode 2), others are skipped.')
+        add('--out_of_core_memory', type=float, default=default_out_of_core_memory, help='Memory budget (in GB) for the slabs in --out_of_core mode.')
+        add('--scratch_dir', type=str, default=None, help='Directory for the --out_of_core scratch file. (default is the directory of the output)')
         add('--verbosity', type=int, default=default_verbosity_level, help='verbosity level')
 
         if len(sys.argv) == 1:  # if no args print usage.
@@ -54,6 +83,9 @@ class ArgumentParser():
 
     def validate(self, args):
 
+        if args.out_of_core and args.fft_padding != 'none':
+            self.error('--fft_padding can not be used with --out_of_core')
+
         if sys.version_info < (2, 7):
             self.error("Python version 2.7 or later is required.")
 
@@ -64,6 +96,10 @@ plot_filters = [] #[0] #[0]  # [0,10,29] #[0,1,2]
 keep_header_apix = True #use the original pixel size in the header of the output file. (apix is still used for the dose weighting). This avoids mismatches in pixel size between the input and output stacks.
 default_starting_tilt_angle = 0
 default_verbosity_level = 3
+default_out_of_core_memory = 4.0
+default_io_threads = 4
+default_filter_cache_size = 0.0 # the filter cache is off unless asked for
+default_filter_cache_dir = os.path.join(os.path.expanduser('~'), '.tomo_preprocess', 'filter_cache')
 ####
 if plot_filters != []:  # only use if matplotlib available
     import matplotlib.pyplot as plt
@@ -75,8 +111,64 @@ def verbosity_print(verbosity, desired_verbosity, string):
         print(string)
 
 
+class FilterCache:
+    # Filters saved as .npy files so later runs can memory map them rather than calculate them again. Once the files
+    # take up more than max_size the least recently used are deleted.
+    def __init__(self, directory=default_filter_cache_dir, max_size=default_filter_cache_size):
+        self.directory = directory
+        self.max_size = max_size # in GB
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        if self.max_size <= 0 or not os.path.isfile(path):
+            return None
+        try:
+            filter_array = np.load(path, mmap_mode='r')
+            os.utime(path, None) # now the most recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return filter_array
+
+    def put(self, key, filter_array):
+        if self.max_size <= 0 or filter_array.nbytes > self.max_size * 1024 ** 3:
+            return
+        # Written to a temporary file first so that other processes never load a half written filter.
+        path = self.path(key)
+        temp_file = '%s.%d' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temp_file, 'wb') as f:
+                np.save(f, filter_array)
+            os.rename(temp_file, path)
+            self.clean_up()
+        except (IOError, OSError):
+            verbosity_print(verbosity, 1, 'Could not save the filter to %s.' % path)
+
+    def clean_up(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npy')]
+        paths = sorted(paths, key=os.path.getmtime, reverse=True) # most recently used first
+        total_size = 0
+        for path in paths:
+            total_size += os.path.getsize(path)
+            if total_size > self.max_size * 1024 ** 3:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+filter_cache = FilterCache()
+per_file_value_types = collections.OrderedDict([('number_of_tilts', int), ('dose_per_tilt', float), ('pre_dose', float)])
+shared_precalculated_dws = [] # set before the --jobs worker processes are started so they share their filters
+precalculated_attributes = ['filter_array', 'image_shape', 'fft_shape', 'apix', 'is_single_image', 'is_image_stack', 'is_single_volume', 'is_volume_stack']
+
+
 class DoseWeightSharpen:
-    def __init__(self, input_file, dose_per_tilt, pre_dose, number_of_tilts, apix, interpret_as_slices, interpret_as_images, file_append, in_place, copy_file_init_from=None, plot_filters=[]):
+    def __init__(self, input_file, dose_per_tilt, pre_dose, number_of_tilts, apix, interpret_as_slices, interpret_as_images, file_append, in_place, copy_file_init_from=None, plot_filters=[], single_precision=False, fft_padding='none', half_spectrum=False, out_of_core=False, out_of_core_memory=default_out_of_core_memory, scratch_dir=None, filter_cache_size=default_filter_cache_size, filter_cache_dir=default_filter_cache_dir, fftw_planning=default_fftw_planning):
         self.a = 0.245
         self.b = -1.665
         self.c = 2.81
@@ -90,9 +182,20 @@ class DoseWeightSharpen:
         self.in_place = in_place
         self.file_append = file_append
         self.plot_filters = plot_filters # list of indices to plot from the images list
+        self.single_precision = single_precision # float32 frequencies and filter and complex64 FFTs (pyfftw, or numpy 2)
+        self.float_dtype = 'float32' if single_precision else 'float64'
+        self.fft_padding = fft_padding # pad to an FFT friendly size (see fft_padding_modes). The filter is made at the padded size.
+        self.half_spectrum = half_spectrum # use rfftn/irfftn with a filter covering only the non-negative x frequencies
+        self.out_of_core = out_of_core # single volumes are sharpened in slabs through a scratch file rather than in memory
+        self.out_of_core_memory = out_of_core_memory # in GB
+        self.scratch_dir = scratch_dir
+        filter_cache.max_size = filter_cache_size
+        filter_cache.directory = filter_cache_dir
+        if use_pfftw:
+            fftw_plans.planning = fftw_planning
         #self.plot_filters = [x for x in self.plot_filters if x >= 0 and x < self.number_of_files]  # remove nonsense values
         if copy_file_init_from==None:
-            self.mrc, self.filter_array, self.apix, self.is_single_image, self.is_image_stack, self.is_single_volume, self.is_volume_stack = self.init_dw_sharpen(self.file_path, self.interpret_as_slices, self.interpret_as_images)
+            self.mrc, self.filter_array, self.image_shape, self.fft_shape, self.apix, self.is_single_image, self.is_image_stack, self.is_single_volume, self.is_volume_stack = self.init_dw_sharpen(self.file_path, self.interpret_as_slices, self.interpret_as_images)
             self.copied_file_init = False
         else:
             self.copy_file_init_from_other(copy_file_init_from)
@@ -104,7 +207,10 @@ class DoseWeightSharpen:
     def init_dw_sharpen(self, input_file, interpret_as_slices, interpret_as_images):
         mrcfile_open_args = [input_file]
         mrcfile_open_kwargs = {'mode': 'r'}
-        mrc = mrcfile.open(*mrcfile_open_args, **mrcfile_open_kwargs)
+        mrcfile_open = mrcfile.mmap if self.out_of_core else mrcfile.open # out of core volumes are never read in whole
+        if not self.out_of_core:
+            mrcfile_open_kwargs['header_only'] = True # the data is only read if this map is sharpened (not when it only provides the precalculated filter)
+        mrc = mrcfile_open(*mrcfile_open_args, **mrcfile_open_kwargs)
         is_single_image, is_image_stack, is_single_volume, is_volume_stack = self.is_stack_or_volume(mrc, interpret_as_slices, interpret_as_images)
         is_stack = is_image_stack or is_volume_stack
         apix = self.multidim_apix_to_single_value(mrc.voxel_size) if self.apix == None else self.apix
@@ -116,16 +222,19 @@ class DoseWeightSharpen:
             freq_array_shape = zyx_shape[1:]
         else:
             freq_array_shape = zyx_shape
-        verbosity_print(verbosity, 2, 'Calculating frequency array...')
-        freq_array = self.create_frequency_array(freq_array_shape, apix)
-        verbosity_print(verbosity, 2, 'Calculating filter array...')
-        filter_array = self.create_filter_array(freq_array)
-        del freq_array
-        return mrc, filter_array, apix, is_single_image, is_image_stack, is_single_volume, is_volume_stack
+        image_shape = freq_array_shape
+        if self.fft_padding != 'none':
+            freq_array_shape = fast_fft_shape(image_shape, range(len(image_shape)))
+            if freq_array_shape != image_shape:
+                verbosity_print(verbosity, 2, 'Padding from %s to %s for the FFTs.' % (str(image_shape), str(freq_array_shape)))
+        if self.out_of_core and is_single_volume:
+            filter_array = None # made a slab at a time
+        else:
+            filter_array = self.cached_filter_array(freq_array_shape, apix)
+        return mrc, filter_array, image_shape, freq_array_shape, apix, is_single_image, is_image_stack, is_single_volume, is_volume_stack
 
     def copy_file_init_from_other(self, dw):
-        copy_attributes = ['filter_array', 'apix', 'is_single_image', 'is_image_stack', 'is_single_volume', 'is_volume_stack']
-        [setattr(self, attr, getattr(dw, attr)) for attr in copy_attributes]
+        [setattr(self, attr, getattr(dw, attr)) for attr in precalculated_attributes]
 
 
     def is_stack_or_volume(self, mrc, interpret_as_slices, interpret_as_images, print_messages=True):
@@ -170,18 +279,23 @@ class DoseWeightSharpen:
 
 
     def dose_weight_sharpen(self):
+        if self.out_of_core and self.is_single_volume:
+            return self.out_of_core_dose_weight_sharpen()
 
         is_stack = self.is_image_stack or self.is_volume_stack
         #str = 'is stack' if is_stack else 'is volume'
         #print(str)
         read_mode = 'r+' if self.in_place else 'r'
+        if self.mrc != None and self.in_place:
+            self.mrc.close() # it was opened read only to set up the filter
+            self.mrc = None
 
-        in_mrc = self.mrc if self.mrc != None else mrcfile.open(self.file_path, mode=read_mode)
+        in_mrc = self.mrc if self.mrc != None else mrcfile.mmap(self.file_path, mode=read_mode) # images are read as they are filtered
         self.img = in_mrc.data
         if not self.in_place:
-            split_path = os.path.splitext(self.file_path)
-            output_file_path = split_path[0]+self.file_append+split_path[1]
-            out_mrc = mrcfile.new(output_file_path, data=np.zeros(self.img.shape, dtype='float32'), overwrite=True)
+            # made at its full size on disk without writing anything. Each filtered image is written straight into it.
+            output_file_path = self.output_file_path(self.file_path)
+            out_mrc = mrcfile.new_mmap(output_file_path, self.img.shape, mrc_mode=2, overwrite=True)
             out_mrc.voxel_size = in_mrc.voxel_size
             out_mrc.set_image_stack() if is_stack else None
         else:
@@ -210,7 +324,7 @@ class DoseWeightSharpen:
             verbosity_print(verbosity, 1, warning_msg)
 
 
-        expected_shape = self.filter_array.shape
+        expected_shape = self.image_shape
         if not is_stack:
             image_shape = self.img.shape
             self.img = [self.img]
@@ -226,21 +340,25 @@ class DoseWeightSharpen:
         if self.plot_filters != []:
             fig = plt.figure()
 
+        stats = None
         for i, image in enumerate(self.img):
             if is_stack:
                 verbosity_print(verbosity, 3, 'Reading image %d of %d...' % (i + 1, number_of_stacked_images))
             if i in self.plot_filters:
                 surf = self.prepare_surf_plot(fig, self.filter_array)
             verbosity_print(verbosity, 3, 'Applying filter...')
-            filter_array = self.fft_shift_filter(self.filter_array)
-            filtered_image = self.overlay_filter(image, filter_array).astype('float32')
+            filtered_image = self.overlay_filter(image, self.filter_array).astype('float32')
             verbosity_print(verbosity, 3, 'Image filtered.')
+            stats = update_stats(stats, filtered_image)
             if is_stack:
                 out_mrc.data[i,...] = filtered_image
-        if not is_stack:
-            out_mrc.set_data(filtered_image)
+        if not is_stack and self.in_place:
+            out_mrc.set_data(filtered_image) # in place the file becomes float32 (mode 2)
+        elif not is_stack:
+            out_mrc.data[...] = filtered_image
         verbosity_print(verbosity, 2, 'Saving stack ...')
 
+        set_header_stats(out_mrc, stats)
         out_mrc.flush()
         out_mrc.close()
         if not self.in_place:
@@ -249,6 +367,94 @@ class DoseWeightSharpen:
         if self.plot_filters != []:
             plt.show()
 
+    def out_of_core_dose_weight_sharpen(self):
+        # The 3D FFT is split into 2D FFTs of z slabs and 1D FFTs along z of y slabs. In between, the (half) spectrum
+        # is kept in a memory mapped scratch file:
+        #   1. rfft2 each z slab of the volume into the scratch file
+        #   2. for each y slab of the scratch file: fft along z, multiply by the filter for that slab, ifft along z
+        #   3. irfft2 each z slab of the scratch file into the output
+        # Only the slabs are ever in memory and they are sized to fit in out_of_core_memory.
+        if self.mrc != None:
+            self.mrc.close()
+        in_mrc = mrcfile.mmap(self.file_path, mode='r+' if self.in_place else 'r')
+        volume = in_mrc.data
+        if self.in_place and volume.dtype != np.float32:
+            # the filtered volume would be cast to the mode of the file (eg truncated to int16) as it is written
+            verbosity_print(verbosity, 1, '%s is not float32 (mode 2) so it can not be sharpened in place out of core. Skipping...' % self.file_path)
+            in_mrc.close()
+            return
+        zsize, ysize, xsize = volume.shape
+        if not self.in_place:
+            output_file_path = self.output_file_path(self.file_path)
+            out_mrc = mrcfile.new_mmap(output_file_path, volume.shape, mrc_mode=2, overwrite=True)
+            out_mrc.voxel_size = in_mrc.voxel_size
+        else:
+            output_file_path = self.file_path
+            out_mrc = in_mrc
+        complex_dtype = 'complex64' if self.single_precision else 'complex128'
+        complex_bytes = np.dtype(complex_dtype).itemsize
+        float_bytes = np.dtype(self.float_dtype).itemsize
+        xhalf = xsize // 2 + 1
+        budget = self.out_of_core_memory * 1024 ** 3
+        plane_bytes = (ysize * xsize * (4 + float_bytes * 2)) + (ysize * xhalf * complex_bytes * 3) # rough peak per z plane of a slab
+        row_bytes = zsize * xhalf * (complex_bytes * 3 + float_bytes * 6) # per y row: the slab, its transforms and the filter (and its temporaries)
+        z_slab = int(max(1, min(zsize, budget // plane_bytes)))
+        y_slab = int(max(1, min(ysize, budget // row_bytes)))
+        scratch_dir = self.scratch_dir if self.scratch_dir != None else os.path.dirname(os.path.abspath(output_file_path))
+        verbosity_print(verbosity, 2, 'Sharpening out of core in slabs of %d z planes and %d y rows (scratch file in %s)...' % (z_slab, y_slab, scratch_dir))
+        with tempfile.NamedTemporaryFile(dir=scratch_dir, suffix='.dw_sharpen_scratch') as scratch_file:
+            spectrum = np.memmap(scratch_file, dtype=complex_dtype, mode='w+', shape=(zsize, ysize, xhalf))
+            verbosity_print(verbosity, 3, 'Transforming z slabs...')
+            for z0 in range(0, zsize, z_slab):
+                slab = np.asarray(volume[z0:z0 + z_slab], dtype=self.float_dtype)
+                spectrum[z0:z0 + z_slab] = np.fft.rfft2(slab, axes=(1, 2))
+            spectrum.flush()
+            verbosity_print(verbosity, 3, 'Filtering y slabs...')
+            axes = self.create_frequency_axes((zsize, ysize, xsize), self.apix, self.float_dtype, half_spectrum=True)
+            for y0 in range(0, ysize, y_slab):
+                block = np.fft.fft(spectrum[:, y0:y0 + y_slab], axis=0)
+                block *= self.create_filter_block(axes, y0, y0 + y_slab)
+                spectrum[:, y0:y0 + y_slab] = np.fft.ifft(block, axis=0)
+                del block
+            spectrum.flush()
+            verbosity_print(verbosity, 3, 'Transforming z slabs back...')
+            stats = None
+            for z0 in range(0, zsize, z_slab):
+                slab = np.fft.irfft2(spectrum[z0:z0 + z_slab], s=(ysize, xsize), axes=(1, 2)).astype('float32')
+                out_mrc.data[z0:z0 + z_slab] = slab
+                stats = update_stats(stats, slab)
+            del spectrum
+        set_header_stats(out_mrc, stats)
+        out_mrc.flush()
+        out_mrc.close()
+        if not self.in_place:
+            in_mrc.close()
+        verbosity_print(verbosity, 2, 'Image saved.')
+
+    def create_filter_block(self, axes, y0, y1):
+        # The (half spectrum) filter for rows y0 to y1 of every z plane.
+        freq_block = np.add.outer(axes[0] ** 2, np.add.outer(axes[1][y0:y1] ** 2, axes[2] ** 2))
+        return self.create_filter_array(np.sqrt(freq_block, out=freq_block))
+
+    def output_file_path(self, input_file):
+        if self.in_place:
+            return input_file
+        split_path = os.path.splitext(input_file)
+        return split_path[0]+self.file_append+split_path[1]
+
+    def read_map(self, input_file):
+        with mrcfile.open(input_file, mode='r') as mrc:
+            return mrc.data, mrc.voxel_size
+
+    def write_map(self, output):
+        output_file, data, voxel_size = output
+        if self.in_place:
+            with mrcfile.open(output_file, mode='r+', header_only=True) as mrc: # the old data is replaced without being read
+                mrc.set_data(data.astype('float32')) # float32 whatever the input mode, as for single maps
+        else:
+            with mrcfile.new(output_file, data=data, overwrite=True) as mrc:
+                mrc.voxel_size = voxel_size
+
     def multidim_apix_to_single_value(self, multidim_apix):
         if type(multidim_apix) == np.recarray:
             apix = float(multidim_apix['x'])
@@ -260,7 +466,7 @@ class DoseWeightSharpen:
         scale_factor = 1
         scale_slice = slice(None, None, scale_factor)
         scale_slices = tuple([scale_slice for j in range(0, filter_array.ndim)])
-        binned_filter_array = self.filter_array[scale_slices]  # a crude resampling for the plot.
+        binned_filter_array = np.fft.fftshift(self.filter_array, axes=tuple(range(self.filter_array.ndim - (1 if self.half_spectrum else 0))))[scale_slices]  # a crude resampling for the plot.
         is_3d = True if filter_array.ndim > 2 else False
         xindex = 2 if is_3d else 1
         yindex = 1 if is_3d else 0
@@ -275,28 +481,39 @@ class DoseWeightSharpen:
         return surf
 
 
-    def create_frequency_array(self, shape, apix):
-        is_3d = True if len(shape)>2 else False
-        xindex = 2 if is_3d else 1
-        yindex = 1 if is_3d else 0
-        zindex = 0 if is_3d else None
-        xsize = shape[xindex]
-        ysize = shape[yindex]
-        zsize = shape[zindex] if is_3d else None
-        xcen = (xsize / 2)  # Brigg's center for array is half the image size +1 pix. I removed the 1 as didn't match with fft.
-        ycen = (ysize / 2)
-        zcen = (zsize / 2) if is_3d else None
-        xrstep = 1 / (xsize * apix)  # reciprocal pixel size
-        yrstep = 1 / (ysize * apix)
-        zrstep = 1 / (zsize * apix) if is_3d else None
-        # iterate over numpy array
-        if is_3d:
-            x,y,z = np.mgrid[0:zsize, 0:ysize, 0:xsize]
-            freq_array = np.sqrt(((xrstep * (x - xcen)) ** 2) + ((yrstep * (y - ycen)) ** 2) + ((zrstep * (z - zcen)) ** 2))
+    def cached_filter_array(self, shape, apix):
+        # The filter from the filter cache (memory mapped) or calculated and added to it.
+        key = (tuple(shape), float(apix), self.dose_per_tilt, self.pre_dose, self.number_of_tilts, self.a, self.b, self.c,
+               self.half_spectrum, self.float_dtype)
+        filter_array = filter_cache.get(key)
+        if filter_array is None:
+            verbosity_print(verbosity, 2, 'Calculating filter array...')
+            filter_array = self.create_shifted_filter_array(shape, apix)
+            filter_cache.put(key, filter_array)
         else:
-            x,y = np.mgrid[0:ysize, 0:xsize]
-            freq_array = np.sqrt(((xrstep * (x - xcen)) ** 2) + ((yrstep * (y - ycen)) ** 2))
-        return freq_array
+            verbosity_print(verbosity, 2, 'Filter array loaded from the filter cache.')
+        return filter_array
+
+    def create_frequency_axes(self, shape, apix, dtype='float64', half_spectrum=False):
+        # The spatial frequencies along each axis in fft order (zero first) so the filter made from them is already fft
+        # shifted. half_spectrum keeps only the x frequencies of rfftn. The axes are always calculated in double precision.
+        axes = [np.fft.fftfreq(size, apix) for size in shape[:-1]]
+        axes.append(np.fft.rfftfreq(shape[-1], apix) if half_spectrum else np.fft.fftfreq(shape[-1], apix))
+        return [axis.astype(dtype) for axis in axes]
+
+    def create_shifted_filter_array(self, shape, apix):
+        # The filter is made one plane (along the first axis) at a time from the frequency axes so that no full size
+        # coordinate or frequency arrays are needed. Only the float32 filter itself is the full size.
+        axes = self.create_frequency_axes(shape, apix, self.float_dtype, self.half_spectrum)
+        plane_squares = np.add.outer(axes[-2] ** 2, axes[-1] ** 2)
+        if len(shape) == 2:
+            return self.create_filter_array(np.sqrt(plane_squares)).astype('float32')
+        filter_array = np.empty((len(axes[0]),) + plane_squares.shape, dtype='float32')
+        freq_plane = np.empty_like(plane_squares)
+        for i, z in enumerate(axes[0]):
+            np.add(plane_squares, z ** 2, out=freq_plane)
+            filter_array[i] = self.create_filter_array(np.sqrt(freq_plane, out=freq_plane))
+        return filter_array
 
     def return_central_slice(self, image):
         slices = [slice(int(dim_size / 2.), None, int(dim_size / 2.)) if i != len(image.shape) - 1 else slice(int(dim_size / 2.),None, None) for i, dim_size in enumerate(image.shape)]
@@ -305,74 +522,279 @@ class DoseWeightSharpen:
     def create_filter_array(self, freq_array):
         np.seterr(divide='ignore', invalid='ignore')  # avoids a zero divide error printed in output.
         t = np.divide(-1, np.multiply(np.add(np.multiply(np.power(freq_array, self.b), self.a), self.c), 2))
-        q = np.divide(np.multiply(np.exp(np.multiply(t, self.dose_per_tilt+self.pre_dose)), np.subtract(1,  np.exp(np.multiply(t, self.dose_per_tilt*self.number_of_tilts)))),          np.multiply(self.number_of_tilts, np.subtract(1, np.exp(np.multiply(t,self.dose_per_tilt)))))
+        # 1 - exp(x) is calculated as -expm1(x) as it loses all its precision for the small t at low frequencies (in single precision especially)
+        q = np.divide(np.multiply(np.exp(np.multiply(t, self.dose_per_tilt+self.pre_dose)), np.negative(np.expm1(np.multiply(t, self.dose_per_tilt*self.number_of_tilts)))),          np.multiply(self.number_of_tilts, np.negative(np.expm1(np.multiply(t,self.dose_per_tilt)))))
         q[np.where(np.isnan(q))] = 1
         q = (1 / q)
         return q
 
 
 
-    def fft_shift_filter(self, filter_array):
-        #axes = (0,1,2) if filter_array.ndim == 3 else (0,1)
-        filter_array = np.fft.ifftshift(filter_array)
-        return filter_array
-
-
     def overlay_filter(self, img, filter_array):
-        if img.ndim == 3:
-            is_3d = True
-            axes = (0,1,2)
-        else:
-            is_3d = False
-            axes = (0, 1)
+        # img can also be a batch of images (or volumes) along an extra first axis.
+        is_3d = len(self.image_shape) == 3
+        axes = tuple(range(img.ndim - len(self.image_shape), img.ndim))
+        if img.shape[axes[0]:] != self.fft_shape:
+            padded_img = pad_image(img, img.shape[:axes[0]] + self.fft_shape, axes, self.fft_padding)
+            return crop_image(self.overlay_filter(padded_img, filter_array), img.shape)
         if use_pfftw:
-            if is_3d:
-                fft_func = pyfftw.interfaces.numpy_fft.fftn
-                ifft_func = pyfftw.interfaces.numpy_fft.ifftn
-            else:
-                fft_func = pyfftw.interfaces.numpy_fft.fft2
-                ifft_func = pyfftw.interfaces.numpy_fft.ifft2
-            pyfftw.interfaces.cache.enable()
+            return fftw_plans.overlay_filter(img, filter_array, axes, half_spectrum=self.half_spectrum, single_precision=self.single_precision)
+        if self.half_spectrum:
+            fft = np.fft.rfftn(img, axes=axes)
+            np.multiply(fft, filter_array, out=fft)
+            return np.fft.irfftn(fft, s=[img.shape[axis] for axis in axes], axes=axes).astype('float32')
+        if is_3d:
+            fft_func = np.fft.fftn
+            ifft_func = np.fft.ifftn
         else:
-            if is_3d:
-                fft_func = np.fft.fftn
-                ifft_func = np.fft.ifftn
-            else:
-                fft_func = np.fft.fft2
-                ifft_func = np.fft.ifft2
+            fft_func = np.fft.fft2
+            ifft_func = np.fft.ifft2
         filtered_img = np.real(ifft_func(np.multiply(fft_func(img, axes=axes), filter_array), axes=axes)).astype('float32')
-        if use_pfftw:
-            pyfftw.interfaces.cache.disable()
         return filtered_img
 
 
 
-def dose_weight_sharpen(input_files, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting, verbosity_level=default_verbosity_level):
+def batched_dose_weight_sharpen(dw, input_files, batch_size, io_threads):
+    # Sharpens equal single images or volumes batch_size at a time with one FFT over the batch. The maps of the next batch
+    # are read and those of the previous batch written on a thread pool while a batch is filtered.
+    if dw.mrc != None:
+        dw.mrc.close()
+    batches = [input_files[i:i + batch_size] for i in range(0, len(input_files), batch_size)]
+    verbosity_print(verbosity, 2, 'Sharpening in batches of %d maps using %d I/O threads...' % (batch_size, io_threads))
+    pool = multiprocessing.pool.ThreadPool(io_threads)
+    try:
+        next_maps = pool.map_async(dw.read_map, batches[0])
+        writes = None
+        for i, batch_files in enumerate(batches):
+            maps = next_maps.get()
+            if i + 1 < len(batches):
+                next_maps = pool.map_async(dw.read_map, batches[i + 1])
+            batch = []
+            for input_file, (data, voxel_size) in zip(batch_files, maps):
+                if data.shape != dw.image_shape:
+                    verbosity_print(verbosity, 1, 'Image %s is not the expected shape %s. Skipping...' % (input_file, str(dw.image_shape)))
+                else:
+                    batch.append((input_file, data, voxel_size))
+            if batch == []:
+                continue
+            filtered_batch = dw.overlay_filter(np.stack([data for input_file, data, voxel_size in batch]), dw.filter_array)
+            if writes is not None:
+                writes.get() # so no more than one batch is waiting to be written
+            writes = pool.map_async(dw.write_map, [(dw.output_file_path(input_file), filtered_image, voxel_size)
+                                                   for (input_file, data, voxel_size), filtered_image in zip(batch, filtered_batch)])
+            verbosity_print(verbosity, 3, 'Sharpened maps %d to %d of %d.' % (i * batch_size + 1, i * batch_size + len(batch_files), len(input_files)))
+        if writes is not None:
+            writes.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SavedPrecalculatedDW:
+    # Stands in for a precalculated DoseWeightSharpen in --jobs workers that are not forked (spawn is the default on
+    # macOS) and so do not inherit shared_precalculated_dws. It only carries the attributes the workers copy, with the
+    # filter saved to a .npy file that each worker memory maps, so the filter is shared (through the page cache) rather
+    # than pickled to each of them.
+    def __init__(self, dw, filter_file):
+        for attr in precalculated_attributes:
+            setattr(self, attr, getattr(dw, attr))
+        self.filter_array = None
+        self.filter_file = filter_file
+
+    def load(self):
+        if self.filter_file != None:
+            self.filter_array = np.load(self.filter_file, mmap_mode='r')
+        return self
+
+
+def saved_precalculated_dw(dw, filter_dir):
+    # A SavedPrecalculatedDW for dw. A filter from the filter cache is already a file, others are saved in filter_dir.
+    # None if the filter can not be saved, then the workers make their own.
+    if dw.filter_array is None or isinstance(dw.filter_array, np.memmap):
+        return SavedPrecalculatedDW(dw, dw.filter_array.filename if dw.filter_array is not None else None)
+    filter_file = os.path.join(filter_dir, '%d.npy' % len(os.listdir(filter_dir)))
+    try:
+        np.save(filter_file, dw.filter_array)
+    except (IOError, OSError):
+        verbosity_print(verbosity, 1, 'Could not save the filter to %s so each process makes its own.' % filter_file)
+        return None
+    return SavedPrecalculatedDW(dw, filter_file)
+
+
+def logged_dose_weight_sharpen_file(job):
+    # Runs in a worker process. The output is collected so it can be printed in order once the map is done.
+    # precalculated is the index of the precalculated dw in shared_precalculated_dws (forked workers), a
+    # SavedPrecalculatedDW (other workers) or None.
+    global verbosity
+    input_file, dw_args, precalculated, dw_sharpen_kwargs, verbosity = job
+    stdout = sys.stdout
+    sys.stdout = log = StringIO()
+    error = None
+    try:
+        if isinstance(precalculated, SavedPrecalculatedDW):
+            try:
+                precalculated_dw = precalculated.load()
+            except (IOError, OSError, ValueError):
+                verbosity_print(verbosity, 1, 'Could not load the precalculated filter from %s. Making it again...' % precalculated.filter_file)
+                precalculated_dw = None
+        else:
+            precalculated_dw = shared_precalculated_dws[precalculated] if precalculated != None else None
+        dw = DoseWeightSharpen(input_file, *dw_args, copy_file_init_from=precalculated_dw, **dw_sharpen_kwargs)
+        dw.mrc = None
+        dw.dose_weight_sharpen()
+    except (Exception, SystemExit):
+        error = traceback.format_exc()
+        print(error)
+    finally:
+        sys.stdout = stdout
+    return input_file, log.getvalue(), error
+
+
+def parallel_dose_weight_sharpen(file_jobs, jobs, dw_sharpen_kwargs):
+    # file_jobs is a list of (input file, dw_args, precalculated DoseWeightSharpen or None) from any number of groups,
+    # all sharpened on one pool. Forked workers are started after shared_precalculated_dws is set so the filters (arrays
+    # or the memory mapped filter cache files) are shared by all of them rather than pickled to each. Workers that are
+    # not forked are given each filter as a .npy file instead (see SavedPrecalculatedDW).
+    global shared_precalculated_dws
+    forked = (multiprocessing.get_start_method() if hasattr(multiprocessing, 'get_start_method') else 'fork') == 'fork' # python 2 always forks
+    filter_dir = None if forked else tempfile.mkdtemp(prefix='dw_sharpen_filters', dir=dw_sharpen_kwargs.get('scratch_dir'))
+    precalculated_dws = []
+    saved_dws = []
+    job_list = []
+    for input_file, dw_args, precalculated_dw in file_jobs:
+        if precalculated_dw != None and all(precalculated_dw is not dw for dw in precalculated_dws):
+            if precalculated_dw.mrc != None:
+                precalculated_dw.mrc.close()
+                precalculated_dw.mrc = None
+            precalculated_dws.append(precalculated_dw)
+            saved_dws.append(saved_precalculated_dw(precalculated_dw, filter_dir) if not forked else None)
+        precalculated_index = [i for i, dw in enumerate(precalculated_dws) if dw is precalculated_dw][0] if precalculated_dw != None else None
+        precalculated = saved_dws[precalculated_index] if not forked and precalculated_index != None else precalculated_index
+        job_list.append((input_file, dw_args, precalculated, dw_sharpen_kwargs, verbosity))
+    shared_precalculated_dws = precalculated_dws
+    jobs = min(jobs, len(job_list))
+    verbosity_print(verbosity, 1, 'Sharpening %d maps using %d processes...' % (len(job_list), jobs))
+    failed = []
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for i, (input_file, log, error) in enumerate(pool.imap(logged_dose_weight_sharpen_file, job_list)):
+            verbosity_print(verbosity, 2, 'File %d of %d: %s' % (i + 1, len(job_list), input_file))
+            if log.strip() != '':
+                print(log.rstrip('\n'))
+            sys.stdout.flush()
+            if error is not None:
+                failed.append((input_file, error.strip().split('\n')[-1]))
+    finally:
+        pool.close()
+        pool.join()
+        shared_precalculated_dws = []
+        if filter_dir != None:
+            shutil.rmtree(filter_dir, ignore_errors=True)
+    if failed != []:
+        print('Dw sharpening failed for %d of %d maps:' % (len(failed), len(job_list)))
+        for input_file, error in failed:
+            print('    %s: %s' % (input_file, error))
+
+
+def read_per_file_values(path):
+    # {map file: {value name: value}} for the per_file_value_types found in a CSV file (with a header line) or a star
+    # file (a loop_ with the same names as labels, eg _number_of_tilts).
+    if os.path.splitext(path)[1] == '.star':
+        labels = []
+        rows = []
+        with open(path) as f:
+            for line in f:
+                values = line.split()
+                if values == [] or values[0].startswith('#') or values[0].startswith('data_') or values[0] == 'loop_':
+                    continue
+                if values[0].startswith('_'):
+                    labels.append(values[0][1:])
+                else:
+                    rows.append(dict(zip(labels, values)))
+    else:
+        with open(path) as f:
+            rows = [dict((key.strip(), value.strip()) for key, value in row.items() if key != None and value != None) for row in csv.DictReader(f)]
+    per_file_values = {}
+    for row in rows:
+        if 'file' not in row:
+            raise ValueError('%s has no "file" column' % path)
+        per_file_values[os.path.normpath(row['file'])] = dict((name, value_type(row[name])) for name, value_type in per_file_value_types.items() if row.get(name, '') != '')
+    return per_file_values
+
+
+def group_input_files(input_files, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, pixel_size, per_file_values=None):
+    # Groups the maps that can share a filter. Only the headers are read (the size, space group and pixel size decide
+    # both the filter and how the map is interpreted). Returns a list of ((number_of_tilts, dose_per_tilt, pre_dose), files).
+    per_file_values = read_per_file_values(per_file_values) if per_file_values != None else {}
+    groups = collections.OrderedDict()
+    for input_file in input_files:
+        values = per_file_values.get(os.path.normpath(input_file), per_file_values.get(os.path.basename(input_file), {}))
+        doses = (values.get('number_of_tilts', number_of_tilts), values.get('dose_per_tilt', dose_per_tilt), values.get('pre_dose', pre_dose))
+        if all_inputs_equal:
+            header_key = None
+        else:
+            with mrcfile.open(input_file, mode='r', header_only=True) as mrc:
+                header = mrc.header
+                apix = pixel_size if pixel_size != None else float(mrc.voxel_size['x'])
+                header_key = (int(header.nx), int(header.ny), int(header.nz), int(header.mz), int(header.ispg), apix)
+        groups.setdefault((header_key, doses), []).append(input_file)
+    return [(doses, files) for (header_key, doses), files in groups.items()]
+
+
+def dose_weight_sharpen(input_files, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting, verbosity_level=default_verbosity_level,
+                        per_file_values=None, batch_size=1, io_threads=default_io_threads, jobs=1, **dw_sharpen_kwargs):
     global verbosity
     verbosity = verbosity_level
     verbosity_print(verbosity, 3, 'Checking input files...')
     for input_file in input_files:
         if not os.path.isfile(input_file):
             raise IOError('Input file %s does not exist' % input_file)
+    groups = group_input_files(input_files, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, pixel_size, per_file_values)
+    if len(groups) > 1:
+        verbosity_print(verbosity, 1, 'The %d files are in %d groups that each share a filter.' % (len(input_files), len(groups)))
+    parallel = jobs > 1 and len(input_files) > 1 and do_not_do_dose_weighting == False # one pool for the maps of every group
+    file_jobs = []
+    for i, ((group_number_of_tilts, group_dose_per_tilt, group_pre_dose), group_files) in enumerate(groups):
+        if len(groups) > 1:
+            verbosity_print(verbosity, 1, 'Group %d of %d: %d files (%s tilts of %s e-/A^2 after %s e-/A^2)' % (
+                i + 1, len(groups), len(group_files), group_number_of_tilts, group_dose_per_tilt, group_pre_dose))
+        file_jobs += dose_weight_sharpen_group(group_files, group_number_of_tilts, group_dose_per_tilt, group_pre_dose, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting,
+                                               parallel, batch_size, io_threads, **dw_sharpen_kwargs)
+    if file_jobs != []:
+        parallel_dose_weight_sharpen(file_jobs, jobs, dw_sharpen_kwargs)
+    verbosity_print(verbosity, 1, 'Done.')
 
 
-    precalculate_arrays = True if all_inputs_equal and len(input_files) > 1 else False
+def dose_weight_sharpen_group(input_files, number_of_tilts, dose_per_tilt, pre_dose, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting,
+                              parallel=False, batch_size=1, io_threads=default_io_threads, **dw_sharpen_kwargs):
+    # Sharpens maps that all share the same filter (which is precalculated once if there is more than one). If parallel
+    # the maps are not sharpened here but returned as (input file, dw_args, precalculated dw) for the --jobs pool.
+    precalculate_arrays = True if len(input_files) > 1 else False
     if precalculate_arrays:
         verbosity_print(verbosity, 1, 'Precalculating arrays...')
-        precalculated_dw = DoseWeightSharpen(input_files[0], dose_per_tilt, pre_dose, number_of_tilts, pixel_size, interpret_as_slices, interpret_as_images, file_append, in_place, plot_filters=plot_filters)
+        precalculated_dw = DoseWeightSharpen(input_files[0], dose_per_tilt, pre_dose, number_of_tilts, pixel_size, interpret_as_slices, interpret_as_images, file_append, in_place, plot_filters=plot_filters, **dw_sharpen_kwargs)
     else:
         precalculated_dw = None
     number_of_files = len(input_files)
+    batched = precalculate_arrays and batch_size > 1 and do_not_do_dose_weighting == False and precalculated_dw.filter_array is not None and (precalculated_dw.is_single_image or precalculated_dw.is_single_volume)
+    if parallel and not batched:
+        dw_args = (dose_per_tilt, pre_dose, number_of_tilts, pixel_size, interpret_as_slices, interpret_as_images, file_append, in_place)
+        return [(input_file, dw_args, precalculated_dw) for input_file in input_files]
     verbosity_print(verbosity, 1, 'Starting dw sharpening%s...' % ' (%d files)' % number_of_files if number_of_files > 1 else '')
+    if batched:
+        if parallel:
+            verbosity_print(verbosity, 1, 'Maps are sharpened in batches (--batch_size) so --jobs is not used for them.')
+        batched_dose_weight_sharpen(precalculated_dw, input_files, batch_size, io_threads)
+        return []
     for i, input_file in enumerate(input_files):
         verbosity_print(verbosity, 2, 'File %d of %d' % (i+1, number_of_files)) if number_of_files > 1 else None
-        dw = DoseWeightSharpen(input_file, dose_per_tilt, pre_dose, number_of_tilts, pixel_size, interpret_as_slices, interpret_as_images, file_append, in_place, plot_filters=plot_filters, copy_file_init_from=precalculated_dw)
+        dw = DoseWeightSharpen(input_file, dose_per_tilt, pre_dose, number_of_tilts, pixel_size, interpret_as_slices, interpret_as_images, file_append, in_place, plot_filters=plot_filters, copy_file_init_from=precalculated_dw, **dw_sharpen_kwargs)
         dw.mrc = precalculated_dw.mrc if precalculate_arrays and i == 0 else None
         if do_not_do_dose_weighting == False:
             dw.dose_weight_sharpen()
         else:
             verbosity_print(verbosity, 2, 'Skipping actually doing the dose weighting as --do_not_do_dose_weighting set')
-    verbosity_print(verbosity, 1, 'Done.')
+    return []
 
 def main(input_map,
         number_of_tilts,
@@ -385,10 +807,11 @@ def main(input_map,
         all_inputs_equal,
         interpret_as_slices,
         interpret_as_images,
-        verbosity
+        verbosity,
+        **dw_sharpen_kwargs
         ):
     input_maps = sorted(glob.glob(input_map))
-    dose_weight_sharpen(input_maps, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting, verbosity)
+    dose_weight_sharpen(input_maps, number_of_tilts, dose_per_tilt, pre_dose, all_inputs_equal, in_place, file_append, pixel_size, interpret_as_slices, interpret_as_images, plot_filters, do_not_do_dose_weighting, verbosity, **dw_sharpen_kwargs)
 
 
 if __name__ == "__main__":
@@ -407,7 +830,20 @@ if __name__ == "__main__":
         args.all_inputs_equal,
         args.interpret_as_slices,
         args.interpret_as_images,
-        args.verbosity
+        args.verbosity,
+        single_precision=args.single_precision,
+        fft_padding=args.fft_padding,
+        half_spectrum=args.half_spectrum,
+        batch_size=args.batch_size,
+        io_threads=args.io_threads,
+        jobs=args.jobs,
+        per_file_values=args.per_file_values,
+        filter_cache_size=args.filter_cache_size,
+        filter_cache_dir=args.filter_cache_dir,
+        fftw_planning=args.fftw_planning,
+        out_of_core=args.out_of_core,
+        out_of_core_memory=args.out_of_core_memory,
+        scratch_dir=args.scratch_dir
         )
 
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# FFT (and output header) helpers shared by tomo_dose_filter and tomo_doseweight_sharpen.
+
+import collections
+import numpy as np
+import os
+import pickle
+import threading
+
+try:
+    import pyfftw
+    have_pyfftw = True
+except ImportError:
+    have_pyfftw = False
+
+
+# Nitpicky details
+fftw_wisdom_file = os.path.join(os.path.expanduser('~'), '.tomo_preprocess', 'fftw_wisdom')  # FFTW plans are saved here so later runs can skip planning
+default_fftw_planning = 'estimate'  # planned at once. measure (and above) can find faster plans but takes seconds to minutes for each new shape, unless it is in the wisdom file
+fft_size_primes = (2, 3, 5, 7)  # padded sizes only have these prime factors (all FFT libraries have fast code for them)
+fftw_plans_per_thread = 2  # plans (and their buffers) kept per thread. eg a stack's full batches and its last, smaller, batch
+####
+
+fft_padding_modes = ['none', 'edge_mean', 'mirror']
+fftw_planning_efforts = ['estimate', 'measure', 'patient', 'exhaustive']
+
+
+def next_fast_size(size):
+    # The smallest size >= size with no prime factors other than fft_size_primes.
+    while True:
+        remainder = size
+        for prime in fft_size_primes:
+            while remainder % prime == 0:
+                remainder //= prime
+        if remainder == 1:
+            return size
+        size += 1
+
+
+def fast_fft_shape(shape, axes):
+    return tuple(next_fast_size(n) if axis in axes else n for axis, n in enumerate(shape))
+
+
+def pad_image(img, padded_shape, axes, mode='edge_mean'):
+    # Pads the end of each of the axes up to padded_shape. edge_mean fills with the mean of the pixels on the edges
+    # of each image (or volume) and mirror reflects the image into the padding.
+    pad_width = [(0, padded_shape[axis] - n) if axis in axes else (0, 0) for axis, n in enumerate(img.shape)]
+    if mode == 'mirror':
+        return np.pad(img, pad_width, mode='symmetric')
+    interior = img[tuple(slice(1, -1) if axis in axes else slice(None) for axis in range(img.ndim))]
+    edge_pixels = np.prod([img.shape[axis] for axis in axes]) - np.prod([interior.shape[axis] for axis in axes])
+    edge_sum = np.sum(img, axis=axes, keepdims=True, dtype='float64') - np.sum(interior, axis=axes, keepdims=True, dtype='float64')
+    padded_img = np.empty(padded_shape, dtype=img.dtype if img.dtype.kind in 'fc' else 'float32')
+    padded_img[...] = edge_sum / edge_pixels
+    padded_img[tuple(slice(0, n) for n in img.shape)] = img
+    return padded_img
+
+
+def crop_image(img, shape):
+    return np.ascontiguousarray(img[tuple(slice(0, n) for n in shape)])
+
+
+def fourier_crop(spectrum, shape, axes, half_spectrum=False):
+    # Crops a spectrum (in fft order, with the last of the axes halved if half_spectrum) to the spectrum of an image of
+    # shape (the sizes along axes). ie only the lowest frequencies are kept.
+    for axis, n in zip(axes, shape):
+        if half_spectrum and axis == axes[-1]:
+            spectrum = np.take(spectrum, np.arange(n // 2 + 1), axis=axis)
+            continue
+        size = spectrum.shape[axis]
+        cropped = np.take(spectrum, np.r_[0:(n + 1) // 2, size - n // 2:size], axis=axis)
+        if n % 2 == 0 and n < size:
+            # The Nyquist frequency of an even cropped size is both +n/2 and -n/2 of the spectrum. The mean of the two
+            # keeps the cropped spectrum Hermitian, so the full and the half spectrum give the same binned image.
+            nyquist = tuple(n // 2 if i == axis else slice(None) for i in range(spectrum.ndim))
+            cropped[nyquist] = (cropped[nyquist] + np.take(spectrum, n // 2, axis=axis)) / 2
+        spectrum = cropped
+    return spectrum
+
+
+def fourier_bin(spectrum, image_shape, factor, axes, half_spectrum=False):
+    # Bins the image(s) of image_shape by factor from their spectrum by cropping it and transforming back at the smaller
+    # size. The binned sizes are rounded down. Scaled so the binned image has the same mean. Returns a float32 array.
+    binned_shape = [image_shape[axis] // factor for axis in axes]
+    cropped = fourier_crop(spectrum, binned_shape, axes, half_spectrum)
+    if half_spectrum:
+        binned = np.fft.irfftn(cropped, s=binned_shape, axes=axes)
+    else:
+        binned = np.real(np.fft.ifftn(cropped, axes=axes))
+    binned *= float(np.prod(binned_shape)) / np.prod([image_shape[axis] for axis in axes])
+    return binned.astype('float32')
+
+
+def update_stats(stats, images):
+    # running [min, max, sum, sum of squares, count] so the header stats don't need another pass over the file.
+    # images can also be the stats of another batch.
+    if type(images) == list:
+        batch_stats = images
+    else:
+        images = np.asarray(images, dtype='float64')
+        batch_stats = [images.min(), images.max(), images.sum(), np.square(images).sum(), images.size]
+    if stats is None:
+        return batch_stats
+    return [min(stats[0], batch_stats[0]), max(stats[1], batch_stats[1])] + [x + y for x, y in zip(stats[2:], batch_stats[2:])]
+
+
+def set_header_stats(mrc, stats):
+    dmin, dmax, total, total_squares, count = stats
+    mean = total / count
+    mrc.header.dmin = dmin
+    mrc.header.dmax = dmax
+    mrc.header.dmean = mean
+    mrc.header.rms = np.sqrt(max((total_squares / count) - (mean ** 2), 0))
+
+
+class FFTWPlans:
+    # FFTW plans are made once for each image shape on preallocated aligned buffers and then reused for every image
+    # of that shape. Each thread gets its own plans (and buffers) so batches can be filtered on a thread pool. Only the
+    # fftw_plans_per_thread most recently used are kept, so the buffers of earlier shapes (which can be GBs) are freed.
+    def __init__(self, wisdom_file=fftw_wisdom_file, planning=default_fftw_planning):
+        self.wisdom_file = wisdom_file
+        self.planning = planning  # one of fftw_planning_efforts
+        self.wisdom_loaded = False
+        self.lock = threading.Lock()
+        self.thread_plans = threading.local()
+
+    def overlay_filter(self, img, filter_array, axes, half_spectrum=False, threads=1, single_precision=False, spectrum_callback=None):
+        # Same as an fft, multiply by filter_array, inverse fft (normalised) and the real part. Returns a new float32 array.
+        # single_precision transforms in complex64 rather than complex128. spectrum_callback(spectrum, filtered) is
+        # called with the spectrum before and after the filter. (the buffer is reused so it must not be kept)
+        fft, ifft = self.get_plans(img.shape, axes, half_spectrum, threads, single_precision)
+        fft.input_array[...] = img
+        spectrum = fft()
+        if spectrum_callback is not None:
+            spectrum_callback(spectrum, False)
+        np.multiply(spectrum, filter_array, out=spectrum)
+        if spectrum_callback is not None:
+            spectrum_callback(spectrum, True)
+        filtered_img = ifft()
+        return np.real(filtered_img).astype('float32')
+
+    def get_plans(self, shape, axes, half_spectrum, threads, single_precision=False):
+        axes = tuple(axis % len(shape) for axis in axes)
+        key = (tuple(shape), axes, half_spectrum, threads, single_precision, self.planning)
+        plans = getattr(self.thread_plans, 'plans', None)
+        if plans is None:
+            plans = self.thread_plans.plans = collections.OrderedDict()  # least recently used first
+        if key in plans:
+            plans[key] = plans.pop(key)
+        else:
+            while len(plans) >= fftw_plans_per_thread:
+                plans.popitem(last=False)  # freed before the new buffers are made
+            plans[key] = self.create_plans(shape, axes, half_spectrum, threads, single_precision)
+        return plans[key]
+
+    def create_plans(self, shape, axes, half_spectrum, threads, single_precision=False):
+        with self.lock:
+            self.load_wisdom()
+        real_dtype, complex_dtype = ('float32', 'complex64') if single_precision else ('float64', 'complex128')
+        if half_spectrum:
+            # real image -> half spectrum -> real image (written back over the image buffer)
+            spectrum_shape = list(shape)
+            spectrum_shape[axes[-1]] = shape[axes[-1]] // 2 + 1
+            image_buffer = pyfftw.empty_aligned(shape, dtype=real_dtype)
+            spectrum_buffer = pyfftw.empty_aligned(spectrum_shape, dtype=complex_dtype)
+        else:
+            # transformed in place
+            image_buffer = pyfftw.empty_aligned(shape, dtype=complex_dtype)
+            spectrum_buffer = image_buffer
+        flags = ('FFTW_%s' % self.planning.upper(),)
+        fft = pyfftw.FFTW(image_buffer, spectrum_buffer, axes=axes, direction='FFTW_FORWARD', flags=flags, threads=threads)
+        ifft = pyfftw.FFTW(spectrum_buffer, image_buffer, axes=axes, direction='FFTW_BACKWARD', flags=flags, threads=threads)
+        with self.lock:
+            self.save_wisdom()
+        return fft, ifft
+
+    def load_wisdom(self):
+        if self.wisdom_loaded:
+            return
+        self.wisdom_loaded = True
+        if not os.path.isfile(self.wisdom_file):
+            return
+        try:
+            with open(self.wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        except Exception:
+            print('Could not read FFTW wisdom from %s. Ignoring it.' % self.wisdom_file)
+
+    def save_wisdom(self):
+        # Written to a temporary file first so that other processes never read a half written file.
+        wisdom_dir = os.path.dirname(self.wisdom_file)
+        temp_file = '%s.%d' % (self.wisdom_file, os.getpid())
+        try:
+            if not os.path.isdir(wisdom_dir):
+                os.makedirs(wisdom_dir)
+            with open(temp_file, 'wb') as f:
+                pickle.dump(pyfftw.export_wisdom(), f, protocol=2)
+            os.rename(temp_file, self.wisdom_file)
+        except (IOError, OSError):
+            print('Could not save FFTW wisdom to %s.' % self.wisdom_file)
+
+
+fftw_plans = FFTWPlans()
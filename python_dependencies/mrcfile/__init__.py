@@ -15,6 +15,8 @@ Functions
 * :func:`new`: Create a new MRC file.
 * :func:`open`: Open an MRC file.
 * :func:`mmap`: Open a memory-mapped MRC file (fast for large files).
+* :func:`new_mmap`: Create a new empty memory-mapped MRC file (fast for large
+  files).
 * :func:`validate`: Validate an MRC file (not implemented yet!)
 
 Basic usage
@@ -73,6 +75,7 @@ from .constants import MRC_FORMAT_VERSION, MAP_ID, MAP_ID_OFFSET_BYTES
 from .gzipmrcfile import GzipMrcFile
 from .mrcfile import MrcFile
 from .mrcmemmap import MrcMemmap
+from . import utils
 from .version import __version__
 
 
@@ -113,7 +116,7 @@ def new(name, data=None, compression=None, overwrite=False):
     return mrc
 
 
-def open(name, mode='r', permissive=False):  # @ReservedAssignment
+def open(name, mode='r', permissive=False, header_only=False):  # @ReservedAssignment
     """Open an MRC file.
     
     This function opens both normal and compressed MRC files. Supported
@@ -127,6 +130,10 @@ def open(name, mode='r', permissive=False):  # @ReservedAssignment
         mode: The file mode to use. This should be one of the following: 'r' for
             read-only, 'r+' for read and write, or 'w+' for a new empty file.
             The default is 'r'.
+        header_only: If True, only the header and extended header are read
+            now. The data block is read the first time the ``data`` attribute
+            is used, which makes checking the headers of many large files fast.
+            The file size is not checked. The default is False.
     
     Returns:
         An :class:`~mrcfile.mrcfile.MrcFile` object (or a
@@ -159,7 +166,8 @@ def open(name, mode='r', permissive=False):  # @ReservedAssignment
                 NewMrc = GzipMrcFile
             elif start[:2] == b'BZ':
                 NewMrc = Bzip2MrcFile
-    return NewMrc(name, mode=mode, permissive=permissive)
+    return NewMrc(name, mode=mode, permissive=permissive,
+                  header_only=header_only)
 
 
 def mmap(name, mode='r', permissive=False):
@@ -184,6 +192,51 @@ def mmap(name, mode='r', permissive=False):
     return MrcMemmap(name, mode=mode, permissive=permissive)
 
 
+def new_mmap(name, shape, mrc_mode=0, fill=None, overwrite=False):
+    """Create a new, empty memory-mapped MRC file.
+    
+    This function is useful for creating very large files. The data array is
+    created at the right size on disk without being written first, and can then
+    be filled slice-by-slice. The initial contents of the data array can be set
+    with the ``fill`` parameter if needed, but be aware that filling a large
+    array can take a long time.
+    
+    Args:
+        name: The file name to use.
+        shape: The shape of the data array to open.
+        mrc_mode: The MRC mode to use for the new file. One of 0, 1, 2, 4 or 6,
+            which correspond to numpy dtypes as follows:
+            
+            * mode 0 -> int8
+            * mode 1 -> int16
+            * mode 2 -> float32
+            * mode 4 -> complex64
+            * mode 6 -> uint16
+            
+            The default is 0.
+        fill: An optional value to use to fill the new data array. If None, the
+            data array will not be filled and its contents are unspecified.
+            Numpy's usual rules for rounding or rejecting values apply,
+            according to the dtype of the array.
+        overwrite: Flag to force overwriting of an existing file. If False and a
+            file of the same name already exists, the file is not overwritten
+            and an exception is raised.
+    
+    Returns:
+        A new :class:`~mrcfile.mrcmemmap.MrcMemmap` object.
+    
+    Raises:
+        ValueError: If the MRC mode is invalid.
+    """
+    mrc = MrcMemmap(name, mode='w+', overwrite=overwrite)
+    dtype = utils.dtype_from_mode(mrc_mode)
+    mrc._open_memmap(dtype, shape)
+    mrc.update_header_from_data()
+    if fill is not None:
+        mrc.data[...] = fill
+    return mrc
+
+
 def validate(name, print_file=None):
     """Validate an MRC file.
     
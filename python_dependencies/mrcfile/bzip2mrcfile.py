@@ -59,11 +59,12 @@ class Bzip2MrcFile(MrcFile):
     def flush(self):
         """Override flush() since BZ2File objects need special handling."""
         if not self._read_only:
+            data = self.data  # an unread data block is read before the stream is replaced
             self._iostream.close()
             self._iostream = bz2.BZ2File(self._fname, mode='w')
             
             # Arrays converted to bytes so gzip can calculate sizes correctly
             self._iostream.write(self.header.tobytes())
             self._iostream.write(self.extended_header.tobytes())
-            self._iostream.write(self.data.tobytes())
+            self._iostream.write(data.tobytes())
             # no equivalent for flush() with BZ2File
@@ -65,6 +65,7 @@ class GzipMrcFile(MrcFile):
     def flush(self):
         """Override flush() since GzipFile objects need special handling."""
         if not self._read_only:
+            data = self.data  # an unread data block is read before the stream is replaced
             self._iostream.close()
             self._fileobj.seek(0)
             self._iostream = gzip.GzipFile(fileobj=self._fileobj, mode='wb')
@@ -72,6 +73,6 @@ class GzipMrcFile(MrcFile):
             # Arrays converted to bytes so gzip can calculate sizes correctly
             self._iostream.write(self.header.tobytes())
             self._iostream.write(self.extended_header.tobytes())
-            self._iostream.write(self.data.tobytes())
+            self._iostream.write(data.tobytes())
             self._iostream.flush()
             self._fileobj.truncate()
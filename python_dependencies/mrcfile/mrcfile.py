@@ -40,6 +40,10 @@ class MrcFile(MrcInterpreter):
         In mode 'r' or 'r+', the named file is opened from disk and read. In
         mode 'w+' a new empty file is created and will be written to disk at the
         end of the 'with' block (or when flush() or close() is called).
+        
+        With ``header_only=True`` (modes 'r' and 'r+'), only the header and
+        extended header are read when the file is opened and the data is read
+        when it is first used.
     
     """
     
@@ -107,8 +111,9 @@ class MrcFile(MrcInterpreter):
         self._iostream.seek(0)
         super(MrcFile, self)._read()
         
-        # Check if the file is the expected size.
-        if self.data is not None:
+        # Check if the file is the expected size. (not if the data is unread,
+        # since finding the size of a compressed file means reading all of it)
+        if not self._data_unread and self.data is not None:
             actual_size = self._get_file_size()
             expected_size = (self.header.nbytes
                              + self.extended_header.nbytes
@@ -51,9 +51,15 @@ class MrcInterpreter(MrcObject):
     * :meth:`_read`
     * :meth:`_read_data`
     
+    If ``header_only`` is True, only the header and extended header are read
+    when the stream is read. The data block is read the first time the
+    :attr:`data` attribute is used, so code that only looks at the header
+    (shape, mode, voxel size...) reads about 1 KB rather than the whole file.
+    
     """
     
-    def __init__(self, iostream=None, permissive=False, **kwargs):
+    def __init__(self, iostream=None, permissive=False, header_only=False,
+                 **kwargs):
         """Initialise a new MrcInterpreter object.
         
         This initialiser reads the stream if it is given. In general, subclasses
@@ -68,11 +74,15 @@ class MrcInterpreter(MrcObject):
         Args:
             iostream: The I/O stream to use to read and write MRC data. The
                 default is None.
+            header_only: Flag to leave the data block unread until the data
+                attribute is first used. The default is False.
         """
         super(MrcInterpreter, self).__init__(**kwargs)
         
         self._iostream = iostream
         self._permissive = permissive
+        self._header_only = header_only
+        self._data_unread = False
         
         # If iostream is given, initialise by reading it
         if self._iostream is not None:
@@ -109,14 +119,56 @@ class MrcInterpreter(MrcObject):
         
         Before calling this method, the stream should be open and positioned at
         the start of the header. This method will advance the stream to the end
-        of the data block.
+        of the data block (or of the extended header if ``header_only`` is set,
+        in which case the data block is read when it is first used).
         
         Raises:
             ValueError: If the file is not a valid MRC file.
         """
         self._read_header()
         self._read_extended_header()
+        if self._header_only:
+            self._data_unread = True
+        else:
+            self._read_data()
+    
+    @property
+    def data(self):
+        """Get the data as a numpy array.
+        
+        If the data block has not been read yet (see ``header_only``), it is
+        read from the stream now.
+        """
+        if self._data_unread:
+            self._read_unread_data()
+        return self._data
+    
+    def _read_unread_data(self):
+        """Read a data block that was left unread when the stream was read."""
+        self._data_unread = False
+        self._iostream.seek(self.header.nbytes + int(self.header.nsymbt))
         self._read_data()
+    
+    def _data_ndim(self):
+        """Override _data_ndim() to use the header if the data is unread."""
+        if self._data_unread:
+            return len(utils.data_shape_from_header(self.header))
+        return super(MrcInterpreter, self)._data_ndim()
+    
+    def set_extended_header(self, extended_header):
+        """Override set_extended_header() to read an unread data block first.
+        
+        The data block is found from the size of the current extended header.
+        """
+        if self._data_unread:
+            self._read_unread_data()
+        super(MrcInterpreter, self).set_extended_header(extended_header)
+    
+    def set_data(self, data):
+        """Override set_data() so an unread data block is never read."""
+        self._check_writeable()
+        self._data_unread = False
+        super(MrcInterpreter, self).set_data(data)
 
     def _read_header(self):
         """Read the MRC header from the I/O stream.
@@ -215,6 +267,7 @@ class MrcInterpreter(MrcObject):
         """Flush to the stream and clear the header and data attributes."""
         if self._header is not None and not self._iostream.closed:
             self.flush()
+        self._data_unread = False
         self._header = None
         self._extended_header = None
         self._close_data()
@@ -227,11 +280,27 @@ class MrcInterpreter(MrcObject):
         
         Subclasses should override this implementation for streams which do not
         support seek() or truncate().
+        
+        If the data block was never read it is unchanged, so only the header
+        and extended header are written.
         """
         if not self._read_only:
+            if self._data_unread:
+                self._write_headers()
+                return
             self._iostream.seek(0)
             self._iostream.write(self.header)
             self._iostream.write(self.extended_header)
             self._iostream.write(np.ascontiguousarray(self.data))
             self._iostream.truncate()
             self._iostream.flush()
+    
+    def _write_headers(self):
+        """Write the header and extended header over the start of the stream.
+        
+        The data block after them is left as it is.
+        """
+        self._iostream.seek(0)
+        self._iostream.write(self.header)
+        self._iostream.write(self.extended_header)
+        self._iostream.flush()
@@ -61,7 +61,7 @@ class MrcMemmap(MrcFile):
         """
         self._check_writeable()
         if extended_header.nbytes != self._extended_header.nbytes:
-            data_copy = self._data.copy()
+            data_copy = self.data.copy()
             self._close_data()
             self._extended_header = extended_header
             self.header.nsymbt = extended_header.nbytes
@@ -75,18 +75,21 @@ class MrcMemmap(MrcFile):
     def flush(self):
         """Flush the header and data arrays to the file buffer."""
         if not self._read_only:
+            if self._data_unread:
+                self._write_headers()
+                return
             self._iostream.seek(0)
             self._iostream.write(self.header)
             self._iostream.write(self.extended_header)
             
             # Flushing the file before the mmap makes the mmap flush faster
             self._iostream.flush()
-            self._data.flush()
+            self.data.flush()
             self._iostream.flush()
             
             # Seek to end of data block so stream is left in the same position
             # as normal
-            self._iostream.seek(self._data.nbytes, os.SEEK_CUR)
+            self._iostream.seek(self.data.nbytes, os.SEEK_CUR)
     
     def _read_data(self):
         """Read the data block from the file.
@@ -85,6 +85,7 @@ class MrcObject(object):
     * :meth:`_create_default_attributes`
     * :meth:`_close_data`
     * :meth:`_set_new_data`
+    * :meth:`_data_ndim`
     
     """
     
@@ -235,6 +236,10 @@ class MrcObject(object):
         """
         self._data = data
     
+    def _data_ndim(self):
+        """Return the number of dimensions of the data array."""
+        return self.data.ndim
+    
     @property
     def voxel_size(self):
         """Get or set the voxel size in angstroms.
@@ -302,7 +307,7 @@ class MrcObject(object):
         Returns:
             True if the data array is two-dimensional.
         """
-        return self.data.ndim == 2
+        return self._data_ndim() == 2
     
     def is_image_stack(self):
         """Identify whether the file represents a stack of images.
@@ -311,7 +316,7 @@ class MrcObject(object):
             True if the data array is three-dimensional and the space group is
             zero.
         """
-        return (self.data.ndim == 3
+        return (self._data_ndim() == 3
                 and self.header.ispg == IMAGE_STACK_SPACEGROUP)
     
     def is_volume(self):
@@ -321,7 +326,7 @@ class MrcObject(object):
             True if the data array is three-dimensional and the space group is
             not zero.
         """
-        return (self.data.ndim == 3
+        return (self._data_ndim() == 3
                 and self.header.ispg != IMAGE_STACK_SPACEGROUP)
     
     def is_volume_stack(self):
@@ -330,7 +335,7 @@ class MrcObject(object):
         Returns:
             True if the data array is four-dimensional.
         """
-        return self.data.ndim == 4
+        return self._data_ndim() == 4
     
     def set_image_stack(self):
         """Change three-dimensional data to represent an image stack.
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+lib_dir = os.path.join(repo_dir, 'lib')
+dependencies_dir = os.path.join(repo_dir, 'python_dependencies')
+for path in (lib_dir, dependencies_dir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import mrcfile
+
+
+def run_script(script, *args, **kwargs):
+    # Runs one of the lib scripts the way the bin links do. Returns the output (and fails the test on a crash).
+    # start_method runs it with that multiprocessing start method (eg spawn, the default on macOS).
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([dependencies_dir, lib_dir, os.environ.get('PYTHONPATH', '')]),
+               HOME=os.environ.get('TOMO_TEST_HOME', os.environ.get('HOME', '')))
+    command = [sys.executable, os.path.join(lib_dir, script)]
+    start_method = kwargs.get('start_method')
+    if start_method is not None:
+        command = [sys.executable, '-c', 'import multiprocessing, runpy, sys; multiprocessing.set_start_method(%r); '
+                   'sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name="__main__")' % start_method] + command[1:]
+    process = subprocess.Popen(command + list(args), env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode()
+    assert process.returncode == 0, output
+    return output
+
+
+def write_map(path, data, apix=1.0, stack=False):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(data)
+        if stack:
+            mrc.set_image_stack()
+        mrc.voxel_size = apix
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(0)
+
+
+@pytest.fixture(autouse=True)
+def isolated_home(tmp_path, monkeypatch):
+    # The FFTW wisdom and the filter cache live under the home directory.
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.setenv('TOMO_TEST_HOME', str(home))
@@ -0,0 +1,52 @@
+import gzip
+import os
+import shutil
+
+import numpy as np
+
+import mrcfile
+from conftest import write_map
+
+
+def test_header_only_reads_data_when_used(tmp_path, rng):
+    path = str(tmp_path / 'map.mrc')
+    data = rng.normal(0, 1, (4, 6, 8)).astype('float32')
+    write_map(path, data, stack=True)
+    with mrcfile.open(path, header_only=True) as mrc:
+        assert mrc.is_image_stack() and not mrc.is_volume()
+        assert mrc._data_unread
+        assert np.array_equal(mrc.data, data)
+
+
+def test_header_only_r_plus_open_and_close_leaves_file_unchanged(tmp_path, rng):
+    path = str(tmp_path / 'map.mrc')
+    write_map(path, rng.normal(0, 1, (4, 6, 8)).astype('float32'))
+    with open(path, 'rb') as f:
+        before = f.read()
+    mrcfile.open(path, mode='r+', header_only=True).close()
+    with open(path, 'rb') as f:
+        assert f.read() == before
+
+
+def test_header_only_r_plus_header_change_keeps_data(tmp_path, rng):
+    path = str(tmp_path / 'map.mrc')
+    data = rng.normal(0, 1, (4, 6, 8)).astype('float32')
+    write_map(path, data)
+    size = os.path.getsize(path)
+    with mrcfile.open(path, mode='r+', header_only=True) as mrc:
+        mrc.voxel_size = 2.5
+    assert os.path.getsize(path) == size
+    with mrcfile.open(path) as mrc:
+        assert np.isclose(mrc.voxel_size.x, 2.5)
+        assert np.array_equal(mrc.data, data)
+
+
+def test_header_only_r_plus_gzip_keeps_data(tmp_path, rng):
+    path = str(tmp_path / 'map.mrc')
+    data = rng.normal(0, 1, (4, 6, 8)).astype('float32')
+    write_map(path, data)
+    with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    mrcfile.open(path + '.gz', mode='r+', header_only=True).close()
+    with mrcfile.open(path + '.gz') as mrc:
+        assert np.array_equal(mrc.data, data)
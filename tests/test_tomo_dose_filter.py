@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+
+import mrcfile
+from conftest import run_script, write_map
+
+
+def test_binned_outputs_with_default_options(tmp_path, rng):
+    stack = str(tmp_path / 'ts.st')
+    write_map(stack, rng.normal(100, 5, (4, 64, 48)).astype('float32'), apix=1.5, stack=True)
+    run_script('tomo_dose_filter.py', '-i', stack, '--custom_dose_series', '0,3,6,9', '-apix', '1.5', '--binned_outputs', '2,4')
+    for name, shape, apix in [('ts_dw.st', (4, 64, 48), 1.5), ('ts_bin2.st', (4, 32, 24), 3.0), ('ts_dw_bin2.st', (4, 32, 24), 3.0),
+                              ('ts_bin4.st', (4, 16, 12), 6.0), ('ts_dw_bin4.st', (4, 16, 12), 6.0)]:
+        with mrcfile.open(str(tmp_path / name)) as mrc:
+            assert mrc.data.shape == shape
+            assert np.isclose(mrc.voxel_size.x, apix) and np.isclose(mrc.voxel_size.y, apix)
+            assert np.isclose(mrc.data.mean(), 100, atol=1)
+
+
+def test_filter_bank_reuses_filters_when_a_stack_does_not_fit(tmp_path, rng, capsys):
+    import tomo_dose_filter
+    data = rng.normal(100, 5, (6, 64, 48)).astype('float32')
+    filter_bytes = 64 * 48 * 4
+    factors_bytes = 64 * 48 * 8
+    max_memory = (factors_bytes + 3.5 * filter_bytes) / 1024. ** 3  # room for 3 of the 6 filters
+    outputs = []
+    for name in ('a.st', 'b.st'):
+        stack = str(tmp_path / name)
+        write_map(stack, data, stack=True)
+        tomo_dose_filter.tilt_series_dose_weight(stack, 3, 'dw', 1.5, [], None, None, None, False, '0,3,6,9,12,15', 0, 0, 1, False,
+                                                 filter_cache_memory=max_memory)
+        with mrcfile.open(str(tmp_path / name.replace('.st', '_dw.st'))) as mrc:
+            outputs.append(mrc.data.copy())
+    output = capsys.readouterr().out
+    assert 'Filter bank: 0 filters reused and 6 calculated' in output
+    assert 'Filter bank: 3 filters reused and 3 calculated' in output
+    assert np.array_equal(outputs[0], outputs[1])
+    tomo_dose_filter.filter_bank.arrays.clear()
+    tomo_dose_filter.filter_bank.nbytes = 0
+
+
+def test_filter_bank_is_only_used_for_more_than_one_stack_per_job(tmp_path, rng):
+    from tomo_dose_filter import filter_cache_memory_per_job
+    data = rng.normal(100, 5, (3, 32, 24)).astype('float32')
+    for name in ('a.st', 'b.st', 'c.st'):
+        write_map(str(tmp_path / name), data, stack=True)
+    args = ('--custom_dose_series', '0,3,6', '-apix', '1.5')
+    assert 'Filter bank' not in run_script('tomo_dose_filter.py', '-i', str(tmp_path / 'a.st'), *args)
+    assert 'Filter bank' not in run_script('tomo_dose_filter.py', '-i', str(tmp_path / '?.st'), '--jobs', '3', '--force', *args)
+    assert 'Filter bank: 3 filters reused' in run_script('tomo_dose_filter.py', '-i', str(tmp_path / '?.st'), '--force', *args)
+    assert filter_cache_memory_per_job(10, 4, 4.0) == 1.0
+
+
+def test_filter_bank_tells_half_spectra_of_odd_and_even_widths_apart(tmp_path, rng):
+    # Widths 100 and 101 have the same half spectrum shape but not the same frequencies.
+    import tomo_dose_filter
+    data = rng.normal(100, 5, (3, 64, 101)).astype('float32')
+    outputs = []
+    for name, width, filter_cache_memory in [('odd.st', 101, 1.), ('even.st', 100, 1.), ('fresh.st', 100, 0)]:
+        stack = str(tmp_path / name)
+        write_map(stack, data[..., :width], stack=True)
+        tomo_dose_filter.tilt_series_dose_weight(stack, 3, 'dw', 1.5, [], None, None, None, False, '0,3,6', 0, 0, 1, False,
+                                                 half_spectrum=True, filter_cache_memory=filter_cache_memory)
+        with mrcfile.open(str(tmp_path / name.replace('.st', '_dw.st'))) as mrc:
+            outputs.append(mrc.data.copy())
+    tomo_dose_filter.filter_bank.arrays.clear()
+    tomo_dose_filter.filter_bank.nbytes = 0
+    assert np.abs(outputs[1] - outputs[2]).max() < 1e-5 * outputs[2].std()
+
+
+def read_stacks(tmp_path, name, suffixes):
+    # {suffix: (data, (dmin, dmax, dmean, rms))} of the outputs of stack name.
+    stacks = {}
+    for suffix in suffixes:
+        with mrcfile.open(str(tmp_path / (name + suffix))) as mrc:
+            stacks[suffix] = (mrc.data.copy(), (float(mrc.header.dmin), float(mrc.header.dmax), float(mrc.header.dmean), float(mrc.header.rms)))
+    return stacks
+
+
+def test_changed_doses_only_refilter_those_tilts(tmp_path, rng):
+    data = rng.normal(100, 5, (5, 32, 24)).astype('float32')
+    suffixes = ['_dw.st', '_bin2.st', '_dw_bin2.st']
+    args = ('-apix', '1.5', '--binned_outputs', '2')
+    for name in ('ts', 'fresh'):
+        write_map(str(tmp_path / (name + '.st')), data, stack=True)
+    run_script('tomo_dose_filter.py', '-i', str(tmp_path / 'ts.st'), '--custom_dose_series', '0,3,6,9,12', *args)
+    first = read_stacks(tmp_path, 'ts', suffixes)
+    output = run_script('tomo_dose_filter.py', '-i', str(tmp_path / 'ts.st'), '--custom_dose_series', '0,3,20,9,12', *args)
+    assert 'Only the doses of tilts 3 changed' in output
+    assert 'Filtering 1 of the 5 images' in output
+    refiltered = read_stacks(tmp_path, 'ts', suffixes)
+    run_script('tomo_dose_filter.py', '-i', str(tmp_path / 'fresh.st'), '--custom_dose_series', '0,3,20,9,12', *args)
+    fresh = read_stacks(tmp_path, 'fresh', suffixes)
+    for suffix in suffixes:
+        assert np.array_equal(refiltered[suffix][0][[0, 1, 3, 4]], first[suffix][0][[0, 1, 3, 4]])
+        assert np.allclose(refiltered[suffix][0], fresh[suffix][0], atol=1e-4)
+        assert np.allclose(refiltered[suffix][1], fresh[suffix][1], rtol=1e-5)
+    assert not np.allclose(refiltered['_dw.st'][0][2], first['_dw.st'][0][2], atol=1e-4)
+
+
+def test_up_to_date_stacks_are_skipped(tmp_path, rng):
+    stack = str(tmp_path / 'ts.st')
+    write_map(stack, rng.normal(100, 5, (3, 32, 24)).astype('float32'), stack=True)
+    args = ('-i', stack, '--custom_dose_series', '0,3,6', '-apix', '1.5')
+    run_script('tomo_dose_filter.py', *args)
+    mtime = os.path.getmtime(str(tmp_path / 'ts_dw.st'))
+    assert 'is up to date' in run_script('tomo_dose_filter.py', *args)
+    assert os.path.getmtime(str(tmp_path / 'ts_dw.st')) == mtime
+    output = run_script('tomo_dose_filter.py', '--force', *args)
+    assert 'is up to date' not in output and 'Stack saved' in output
+
+
+def test_in_place_marker(tmp_path, rng):
+    data = rng.normal(100, 5, (3, 32, 24)).astype('float32')
+    args = ('--custom_dose_series', '0,3,6', '-apix', '1.5')
+    for name in ('ts.st', 'ref.st'):
+        write_map(str(tmp_path / name), data, stack=True)
+    run_script('tomo_dose_filter.py', '-i', str(tmp_path / 'ref.st'), *args)
+    stack = str(tmp_path / 'ts.st')
+    run_script('tomo_dose_filter.py', '-i', stack, '--in_place', *args)
+    assert not os.path.exists(stack + '.dw_in_progress')
+    with mrcfile.open(stack) as mrc, mrcfile.open(str(tmp_path / 'ref_dw.st')) as reference:
+        assert np.allclose(mrc.data, reference.data, atol=1e-4)
+    # A marker left behind (eg by a crash) means some tilts may already be filtered, so the stack is not touched again.
+    with open(stack + '.dw_in_progress', 'w') as f:
+        f.write('Dose weighting in place\n')
+    with mrcfile.open(stack) as mrc:
+        before = mrc.data.copy()
+    output = run_script('tomo_dose_filter.py', '-i', stack, '--in_place', *args)
+    assert 'was not finished being dose weighted in place' in output
+    with mrcfile.open(stack) as mrc:
+        assert np.array_equal(mrc.data, before)
+    assert os.path.exists(stack + '.dw_in_progress')
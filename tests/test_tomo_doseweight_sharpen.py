@@ -0,0 +1,142 @@
+import glob
+import os
+
+import numpy as np
+
+import mrcfile
+from conftest import run_script, write_map
+
+
+def sharpened_copy(tmp_path, name, data, *args):
+    # Sharpens data (written as name) on its own and returns the output.
+    path = str(tmp_path / name)
+    write_map(path, data, apix=2.0)
+    run_script('tomo_doseweight_sharpen.py', '-i', path, '--number_of_tilts', '10', '-dose', '3', *args)
+    with mrcfile.open(str(tmp_path / (os.path.splitext(name)[0] + '_dw_sharpened.mrc'))) as mrc:
+        return mrc.data.copy()
+
+
+def test_in_place_several_maps(tmp_path, rng):
+    volumes = [rng.normal(0, 1, (8, 10, 12)).astype('float32') for i in range(3)]
+    expected = [sharpened_copy(tmp_path, 'ref%d.mrc' % i, volume) for i, volume in enumerate(volumes)]
+    for i, volume in enumerate(volumes):
+        write_map(str(tmp_path / ('map%d.mrc' % i)), volume, apix=2.0)
+    run_script('tomo_doseweight_sharpen.py', '-i', str(tmp_path / 'map*.mrc'), '--number_of_tilts', '10', '-dose', '3', '--in_place')
+    assert glob.glob(str(tmp_path / 'map*_dw_sharpened.mrc')) == []
+    for i, reference in enumerate(expected):
+        with mrcfile.open(str(tmp_path / ('map%d.mrc' % i))) as mrc:
+            assert np.allclose(mrc.data, reference, atol=1e-5)
+
+
+def test_jobs_run_one_pool_across_groups(tmp_path, rng):
+    # Every map has its own shape, so each is its own group.
+    volumes = [rng.normal(0, 1, shape).astype('float32') for shape in [(8, 10, 12), (6, 10, 12), (8, 8, 12)]]
+    expected = [sharpened_copy(tmp_path, 'ref%d.mrc' % i, volume) for i, volume in enumerate(volumes)]
+    for i, volume in enumerate(volumes):
+        write_map(str(tmp_path / ('map%d.mrc' % i)), volume, apix=2.0)
+    output = run_script('tomo_doseweight_sharpen.py', '-i', str(tmp_path / 'map*.mrc'), '--number_of_tilts', '10', '-dose', '3', '--jobs', '3')
+    assert 'in 3 groups' in output
+    assert 'Sharpening 3 maps using 3 processes' in output
+    assert 'failed' not in output
+    for i, reference in enumerate(expected):
+        with mrcfile.open(str(tmp_path / ('map%d_dw_sharpened.mrc' % i))) as mrc:
+            assert np.allclose(mrc.data, reference, atol=1e-5)
+
+
+def test_jobs_with_spawned_workers(tmp_path, rng):
+    # Spawned workers do not inherit the precalculated filter so it is passed to them as a file.
+    volumes = [rng.normal(0, 1, (8, 10, 12)).astype('float32') for i in range(3)]
+    expected = [sharpened_copy(tmp_path, 'ref%d.mrc' % i, volume) for i, volume in enumerate(volumes)]
+    for i, volume in enumerate(volumes):
+        write_map(str(tmp_path / ('map%d.mrc' % i)), volume, apix=2.0)
+    output = run_script('tomo_doseweight_sharpen.py', '-i', str(tmp_path / 'map*.mrc'), '--number_of_tilts', '10', '-dose', '3', '--jobs', '2',
+                        start_method='spawn')
+    assert 'failed' not in output
+    for i, reference in enumerate(expected):
+        with mrcfile.open(str(tmp_path / ('map%d_dw_sharpened.mrc' % i))) as mrc:
+            assert np.allclose(mrc.data, reference, atol=1e-5)
+
+
+def test_batches_with_half_spectrum_without_pyfftw(tmp_path, rng, monkeypatch):
+    import tomo_doseweight_sharpen
+    monkeypatch.setattr(tomo_doseweight_sharpen, 'use_pfftw', False)
+    volumes = [rng.normal(0, 1, (8, 10, 12)).astype('float32') for i in range(5)]
+    paths = []
+    for i, volume in enumerate(volumes):
+        paths.append(str(tmp_path / ('map%d.mrc' % i)))
+        write_map(paths[-1], volume, apix=2.0)
+    for batch_size in (1, 2):
+        tomo_doseweight_sharpen.dose_weight_sharpen(paths, 10, 3., 0., True, False, '_b%d' % batch_size, None, False, False, [], False, 0,
+                                                    batch_size=batch_size, half_spectrum=True, filter_cache_size=0)
+    for i in range(len(volumes)):
+        with mrcfile.open(str(tmp_path / ('map%d_b1.mrc' % i))) as single, mrcfile.open(str(tmp_path / ('map%d_b2.mrc' % i))) as batched:
+            assert np.allclose(batched.data, single.data, atol=1e-5)
+
+
+def test_batches_in_place_become_float32(tmp_path, rng):
+    volumes = [rng.normal(600, 50, (8, 10, 12)).astype('int16') for i in range(4)]
+    expected = [sharpened_copy(tmp_path, 'ref%d.mrc' % i, volume) for i, volume in enumerate(volumes)]
+    for i, volume in enumerate(volumes):
+        write_map(str(tmp_path / ('map%d.mrc' % i)), volume, apix=2.0)
+    run_script('tomo_doseweight_sharpen.py', '-i', str(tmp_path / 'map*.mrc'), '--number_of_tilts', '10', '-dose', '3', '--in_place',
+               '--all_inputs_equal', '--batch_size', '2')
+    for i, reference in enumerate(expected):
+        with mrcfile.open(str(tmp_path / ('map%d.mrc' % i))) as mrc:
+            assert mrc.header.mode == 2
+            assert np.allclose(mrc.data, reference, atol=1e-3)
+            assert np.isclose(mrc.voxel_size.x, 2.0)
+
+
+def test_out_of_core_matches_in_memory(tmp_path, rng):
+    volume = rng.normal(0, 1, (8, 10, 12)).astype('float32')
+    expected = sharpened_copy(tmp_path, 'ref.mrc', volume)
+    out_of_core_args = ('--out_of_core', '--out_of_core_memory', '1e-6')  # slabs of one plane (or row)
+    sharpened = sharpened_copy(tmp_path, 'map.mrc', volume, *out_of_core_args)
+    assert np.allclose(sharpened, expected, atol=1e-5)
+    path = str(tmp_path / 'in_place.mrc')
+    write_map(path, volume, apix=2.0)
+    run_script('tomo_doseweight_sharpen.py', '-i', path, '--number_of_tilts', '10', '-dose', '3', '--in_place', *out_of_core_args)
+    with mrcfile.open(path) as mrc:
+        assert np.allclose(mrc.data, expected, atol=1e-5)
+        assert np.isclose(mrc.header.rms, expected.std(), rtol=1e-4)
+
+
+def test_out_of_core_in_place_skips_maps_that_are_not_float32(tmp_path, rng):
+    volume = rng.normal(600, 50, (8, 10, 12)).astype('int16')
+    path = str(tmp_path / 'map.mrc')
+    write_map(path, volume, apix=2.0)
+    output = run_script('tomo_doseweight_sharpen.py', '-i', path, '--number_of_tilts', '10', '-dose', '3', '--in_place', '--out_of_core')
+    assert 'not float32' in output
+    with mrcfile.open(path) as mrc:
+        assert mrc.header.mode == 1
+        assert np.array_equal(mrc.data, volume)
+
+
+def test_filter_cache_is_opt_in(tmp_path, rng):
+    volume = rng.normal(0, 1, (8, 10, 12)).astype('float32')
+    sharpened_copy(tmp_path, 'a.mrc', volume)
+    assert not os.path.exists(os.path.join(os.environ['HOME'], '.tomo_preprocess', 'filter_cache'))
+    cache_dir = str(tmp_path / 'cache')
+    first = sharpened_copy(tmp_path, 'b.mrc', volume, '--filter_cache_size', '1', '--filter_cache_dir', cache_dir)
+    assert len(glob.glob(os.path.join(cache_dir, '*.npy'))) == 1
+    second = sharpened_copy(tmp_path, 'c.mrc', volume, '--filter_cache_size', '1', '--filter_cache_dir', cache_dir)
+    assert np.array_equal(first, second)
+
+
+def reference_sharpening(data, apix, dose_per_tilt, pre_dose, number_of_tilts):
+    # The dose weighting sharpening filter built directly from the frequency of every pixel (in fft order).
+    axes = np.meshgrid(*[np.fft.fftfreq(n, apix) for n in data.shape], indexing='ij')
+    freq = np.sqrt(sum(axis ** 2 for axis in axes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -1 / (2 * (0.245 * freq ** -1.665 + 2.81))
+        q = np.exp(t * (dose_per_tilt + pre_dose)) * np.expm1(t * dose_per_tilt * number_of_tilts) / (number_of_tilts * np.expm1(t * dose_per_tilt))
+    q[np.isnan(q)] = 1
+    return np.real(np.fft.ifftn(np.fft.fftn(data) / q))
+
+
+def test_non_square_maps_match_the_reference_filter(tmp_path, rng):
+    for name, shape in [('volume.mrc', (8, 10, 14)), ('image.mrc', (10, 16))]:
+        data = rng.normal(0, 1, shape).astype('float32')
+        sharpened = sharpened_copy(tmp_path, name, data)
+        expected = reference_sharpening(data.astype('float64'), 2.0, 3., 0., 10)
+        assert np.abs(sharpened - expected).max() < 1e-4 * expected.std()
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from tomo_fft import fourier_bin
+
+
+@pytest.mark.parametrize('shape, factor', [((3, 64, 48), 2), ((3, 64, 48), 4), ((3, 60, 44), 2), ((3, 66, 50), 3), ((3, 63, 45), 2)])
+def test_fourier_bin_half_spectrum_matches_full_spectrum(rng, shape, factor):
+    images = rng.normal(100, 5, shape)
+    full = fourier_bin(np.fft.fftn(images, axes=(1, 2)), shape, factor, (1, 2))
+    half = fourier_bin(np.fft.rfftn(images, axes=(1, 2)), shape, factor, (1, 2), half_spectrum=True)
+    assert full.shape == half.shape == (shape[0], shape[1] // factor, shape[2] // factor)
+    assert np.abs(full - half).max() < 1e-4 * images.std()
+
+
+def test_fourier_bin_keeps_a_band_limited_image(rng):
+    # An image with no frequencies above the binned Nyquist is binned exactly (apart from the sampling).
+    y, x = np.mgrid[0:64, 0:48]
+    image = 10 + np.cos(2 * np.pi * 3 * y / 64.) + np.sin(2 * np.pi * 5 * x / 48.)
+    binned = fourier_bin(np.fft.fftn(image[np.newaxis], axes=(1, 2)), (1, 64, 48), 2, (1, 2))
+    assert np.allclose(binned[0], image[::2, ::2], atol=1e-5)
+
+
+def test_fftw_plans_per_thread_are_bounded(rng):
+    pytest.importorskip('pyfftw')
+    import tomo_fft
+    plans = tomo_fft.FFTWPlans(wisdom_file='/nonexistent/fftw_wisdom')
+    plans.save_wisdom = lambda: None
+    for batch in (4, 4, 3, 4, 2, 1):
+        images = rng.normal(0, 1, (batch, 16, 12))
+        filter_array = rng.uniform(0, 1, (16, 12))
+        filtered = plans.overlay_filter(images, filter_array, (1, 2))
+        expected = np.real(np.fft.ifft2(np.fft.fft2(images) * filter_array))
+        assert np.allclose(filtered, expected, atol=1e-5)
+        assert len(plans.thread_plans.plans) <= tomo_fft.fftw_plans_per_thread
+    assert list(plans.thread_plans.plans)[-1][0] == (1, 16, 12)
+
+
+def test_fftw_planning_effort(rng):
+    pytest.importorskip('pyfftw')
+    import tomo_fft
+    images = rng.normal(0, 1, (2, 16, 12))
+    filter_array = rng.uniform(0, 1, (16, 12))
+    expected = np.real(np.fft.ifft2(np.fft.fft2(images) * filter_array))
+    for planning in tomo_fft.fftw_planning_efforts[:2]:
+        plans = tomo_fft.FFTWPlans(wisdom_file='/nonexistent/fftw_wisdom', planning=planning)
+        plans.save_wisdom = lambda: None
+        assert np.allclose(plans.overlay_filter(images, filter_array, (1, 2)), expected, atol=1e-5)
+        fft, ifft = list(plans.thread_plans.plans.values())[0]
+        assert ('FFTW_%s' % planning.upper()) in fft.flags
+    assert tomo_fft.fftw_plans.planning == 'estimate'